@@ -9,9 +9,10 @@ from methods import (
     FlatRateShipping, FreeShipping, ShippingTable, ShippingTableLine,
 )
 from shipping import (
-    NereidShipping, DefaultCheckout, WebsiteShipping, Website, SaleLine,
-    AvailableCountries,
+    NereidShipping, DefaultCheckout, WebsiteShipping, Website, Sale,
+    SaleLine, Template, AvailableCountries, ShippingEligibility,
 )
+from estimate import ShippingEstimate, Product
 
 from trytond.pool import Pool
 
@@ -30,6 +31,11 @@ def register():
         FreeShipping,
         ShippingTable,
         ShippingTableLine,
+        Sale,
         SaleLine,
+        Template,
+        ShippingEstimate,
+        Product,
+        ShippingEligibility,
         module='nereid_shipping', type_='model'
     )
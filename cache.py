@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""
+    cache
+
+    Caches of shipping quotes, shared by the processes and hosts which
+    serve a database when a shared backend is configured
+
+    :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) LTD
+    :license: GPLv3, see LICENSE for more details.
+"""
+import os
+import time
+import socket
+import logging
+import tempfile
+import threading
+import cPickle as pickle
+from hashlib import sha1
+from urlparse import urlsplit
+
+from trytond.cache import Cache
+from trytond.config import CONFIG
+from trytond.transaction import Transaction
+
+__all__ = [
+    'QuoteCache', 'MemoryBackend', 'FileBackend', 'RedisBackend',
+    'SharedCache', 'get_backend',
+]
+
+logger = logging.getLogger('nereid.shipping.cache')
+
+
+class QuoteCache(Cache):
+    """
+    A trytond LRU cache whose entries also expire after a time to live.
+
+    Like any trytond cache, it is kept per database and :meth:`clear` is
+    propagated to the other processes when the server runs in multi server
+    mode.
+
+    :param name: Unique name of the cache
+    :param size_limit: Maximum number of entries kept per database
+    :param ttl: Default time to live of an entry in seconds
+    """
+
+    def __init__(self, name, size_limit=1024, ttl=300):
+        super(QuoteCache, self).__init__(
+            name, size_limit=size_limit, context=False
+        )
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        entry = super(QuoteCache, self).get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires < time.time():
+            return default
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Cache the value under the key
+
+        :param ttl: Time to live of the entry in seconds, if it should be
+                    different from the default of the cache
+        """
+        super(QuoteCache, self).set(
+            key, (time.time() + (ttl or self.ttl), value)
+        )
+        return value
+
+
+class CacheBackendError(Exception):
+    "Raised by the backends when the store fails"
+
+
+class MemoryBackend(object):
+    """
+    Entries kept in the memory of the process, in a :class:`QuoteCache`.
+    Clearing it is propagated to the other processes like the clearing of
+    any trytond cache.
+    """
+
+    def __init__(self, name):
+        self._cache = QuoteCache(name)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value, ttl):
+        self._cache.set(key, value, ttl)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class FileBackend(object):
+    """
+    Entries kept as files in a directory, which could be shared by the
+    processes of a host. Each entry is written to a temporary file which
+    is then renamed, so that readers never see a partial entry.
+
+    The time of modification of an entry is set to its expiry, so that the
+    expired entries are found without reading them. They are removed by
+    :meth:`sweep`, which runs when the cache is cleared and at most every
+    `sweep_interval` seconds when entries are set.
+
+    :param directory: Path of the directory, created if need be
+    :param sweep_interval: Seconds between the sweeps run when entries
+                           are set
+    :param max_entries: Number of entries kept by a sweep, the ones which
+                        expire first are removed beyond it
+    """
+
+    #: Prefix of the temporary files of the entries being written
+    temp_prefix = '.tmp'
+
+    #: Age in seconds of the temporary files which a sweep considers left
+    #: behind by an interrupted process
+    temp_max_age = 3600
+
+    def __init__(self, directory, sweep_interval=300, max_entries=10000):
+        self.directory = directory
+        self.sweep_interval = sweep_interval
+        self.max_entries = max_entries
+        self._next_sweep = time.time() + sweep_interval
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, sha1(key).hexdigest())
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as stream:
+                expires, value = pickle.load(stream)
+        except IOError:
+            return None
+        except (EOFError, ValueError, pickle.UnpicklingError) as error:
+            raise CacheBackendError(error)
+        if expires < time.time():
+            self._unlink(path)
+            return None
+        return value
+
+    def set(self, key, value, ttl):
+        expires = time.time() + ttl
+        fd, path = tempfile.mkstemp(
+            prefix=self.temp_prefix, dir=self.directory
+        )
+        try:
+            with os.fdopen(fd, 'wb') as stream:
+                pickle.dump((expires, value), stream, 2)
+            os.utime(path, (expires, expires))
+            os.rename(path, self._path(key))
+        except Exception:
+            self._unlink(path)
+            raise
+        if time.time() >= self._next_sweep:
+            self.sweep()
+
+    def sweep(self):
+        """Remove the expired entries, the temporary files left behind and
+        the entries which expire first beyond `max_entries`
+        """
+        now = time.time()
+        self._next_sweep = now + self.sweep_interval
+
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            if name.startswith(self.temp_prefix):
+                if mtime < now - self.temp_max_age:
+                    self._unlink(path)
+            elif mtime < now:
+                self._unlink(path)
+            else:
+                entries.append((mtime, path))
+
+        entries.sort()
+        for mtime, path in entries[:max(len(entries) - self.max_entries, 0)]:
+            self._unlink(path)
+
+    def clear(self):
+        """Sweep the directory. The entries of the old versions of the
+        configuration are left to expire, see :class:`SharedCache`.
+        """
+        self.sweep()
+
+
+class RedisBackend(object):
+    """
+    Entries kept in a server which speaks the Redis protocol, shared by
+    every host. Each thread has its own connection to the server.
+
+    :param host: Host name of the server
+    :param port: Port of the server
+    :param db: Number of the database on the server
+    :param password: Password of the server, if it requires one
+    :param timeout: Seconds to wait for the server
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None,
+                 timeout=1):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        connection = socket.create_connection(
+            (self.host, self.port), self.timeout
+        )
+        self._local.connection = connection
+        self._local.reader = connection.makefile('rb')
+        if self.password:
+            self._command('AUTH', self.password)
+        if self.db:
+            self._command('SELECT', self.db)
+
+    def _command(self, *args):
+        "Send the command and return its reply"
+        if getattr(self._local, 'connection', None) is None:
+            self._connect()
+        request = ['*%d\r\n' % len(args)]
+        for arg in args:
+            arg = str(arg)
+            request.append('$%d\r\n%s\r\n' % (len(arg), arg))
+        try:
+            self._local.connection.sendall(''.join(request))
+            return self._read_reply()
+        except (socket.error, CacheBackendError):
+            self._local.connection.close()
+            self._local.connection = None
+            raise
+
+    def _read_reply(self):
+        line = self._local.reader.readline()
+        if not line.endswith('\r\n'):
+            raise CacheBackendError('Connection closed')
+        kind, data = line[0], line[1:-2]
+        if kind == '+':
+            return data
+        elif kind == '-':
+            raise CacheBackendError(data)
+        elif kind == ':':
+            return int(data)
+        elif kind == '$':
+            if int(data) < 0:
+                return None
+            value = self._local.reader.read(int(data) + 2)
+            return value[:-2]
+        elif kind == '*':
+            if int(data) < 0:
+                return None
+            return [self._read_reply() for i in xrange(int(data))]
+        raise CacheBackendError('Invalid reply %r' % line)
+
+    def get(self, key):
+        value = self._command('GET', key)
+        if value is not None:
+            return pickle.loads(value)
+
+    def set(self, key, value, ttl):
+        self._command(
+            'SET', key, pickle.dumps(value, 2), 'PX', int(ttl * 1000)
+        )
+
+    def clear(self):
+        "Entries are invalidated by version, see :class:`SharedCache`"
+        pass
+
+
+def get_backend(name, url):
+    """Return the backend of the URL, which is one of:
+
+        memory://
+        file:///path/of/the/directory
+        redis://[:password@]host[:port][/db]
+
+    :param name: Unique name of the cache
+    """
+    parts = urlsplit(url)
+    if parts.scheme == 'file':
+        return FileBackend(os.path.join(parts.path, name))
+    elif parts.scheme == 'redis':
+        return RedisBackend(
+            parts.hostname or 'localhost', parts.port or 6379,
+            int(parts.path.strip('/') or 0), parts.password
+        )
+    return MemoryBackend(name)
+
+
+class SharedCache(object):
+    """
+    A cache of values by website in a pluggable backend, which is chosen
+    by the `shipping_cache` option of the trytond configuration
+    (memory:// by default, see :func:`get_backend`).
+
+    The entries of a website are stored under the version of its shipping
+    configuration (see NereidShipping.get_config_version), so that a
+    change to the configuration invalidates the entries of every process
+    at once, as soon as it is committed. Errors of the backend are logged
+    and handled as misses.
+
+    :param name: Unique name of the cache
+    :param ttl: Default time to live of an entry in seconds
+    """
+
+    def __init__(self, name, ttl=3600):
+        self.name = name
+        self.ttl = ttl
+        self._backend = None
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = get_backend(
+                self.name, CONFIG.get('shipping_cache') or 'memory://'
+            )
+        return self._backend
+
+    @backend.setter
+    def backend(self, backend):
+        self._backend = backend
+
+    def _get_key(self, website, version, key):
+        return '%s:%s:%s:%s:%s' % (
+            self.name, Transaction().cursor.database_name, website, version,
+            sha1(repr(key)).hexdigest()
+        )
+
+    def get(self, website, version, key, default=None):
+        """Return the value cached under the key for the version of the
+        configuration of the website, or the default
+        """
+        try:
+            value = self.backend.get(self._get_key(website, version, key))
+        except (CacheBackendError, EnvironmentError) as error:
+            logger.warning("Shipping cache %s failed: %s", self.name, error)
+            return default
+        return default if value is None else value
+
+    def set(self, website, version, key, value, ttl=None):
+        """Cache the value under the key for the version of the
+        configuration of the website and return it
+
+        :param ttl: Time to live of the entry in seconds, if it should be
+                    different from the default of the cache
+        """
+        try:
+            self.backend.set(
+                self._get_key(website, version, key), value, ttl or self.ttl
+            )
+        except (CacheBackendError, EnvironmentError) as error:
+            logger.warning("Shipping cache %s failed: %s", self.name, error)
+        return value
+
+    def clear(self):
+        """Clear the entries kept in the memory of the processes. The
+        entries of the shared backends are left to expire.
+        """
+        self.backend.clear()
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+    carrier
+
+    Rates of shipping methods which are computed by the rating APIs of
+    carriers over HTTP.
+
+    A carrier method computes its rates in two phases: it first describes
+    the HTTP requests to the API of the carrier (get_rate_requests), and
+    then turns the responses into options (parse_rate_responses). In
+    between, the requests of all the carrier methods of a quote are sent
+    at the same time, over connections which are kept alive and shared by
+    the whole process, while the other methods compute their rates. A
+    pruned quote, which may stop early, sends the requests of each carrier
+    method only once it gets to the method.
+
+    :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) LTD
+    :license: GPLv3, see LICENSE for more details.
+"""
+import json
+import time
+import socket
+import httplib
+import threading
+import urlparse
+from collections import defaultdict
+
+from trytond.pool import Pool
+
+__all__ = [
+    'RateRequest', 'RateResponse', 'ConnectionPool', 'CarrierFetch',
+    'CarrierRateMixin', 'connection_pool',
+]
+
+
+class RateRequest(object):
+    """
+    An HTTP request to the rating API of a carrier
+
+    :param url: Absolute http or https URL
+    :param body: Body of the request, which makes it a POST by default
+    :param method: HTTP method
+    :param headers: Dictionary of the headers
+    :param timeout: Seconds to wait for the connection and for each read,
+                    by default the timeout of the method
+    :param data: Anything the method needs to parse the response
+    """
+    __slots__ = ('url', 'body', 'method', 'headers', 'timeout', 'data')
+
+    def __init__(self, url, body=None, method=None, headers=None,
+                 timeout=None, data=None):
+        self.url = url
+        self.body = body
+        self.method = method or (body is None and 'GET' or 'POST')
+        self.headers = headers or {}
+        self.timeout = timeout
+        self.data = data
+
+
+class RateResponse(object):
+    """
+    The response to a :class:`RateRequest`, or the error which prevented
+    it (a socket.error, including socket.timeout, or an
+    httplib.HTTPException)
+    """
+    __slots__ = ('request', 'status', 'headers', 'body', 'error')
+
+    def __init__(self, request, status=None, headers=None, body=None,
+                 error=None):
+        self.request = request
+        self.status = status
+        self.headers = headers or {}
+        self.body = body
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None and 200 <= self.status < 300
+
+    @property
+    def failed(self):
+        """True if the request failed in a way which could succeed when
+        sent again: an error, including a timeout, or a server error
+        """
+        return self.error is not None or self.status >= 500
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class ConnectionPool(object):
+    """
+    HTTP and HTTPS connections kept alive by host, shared by the threads
+    of the process
+
+    :param maxsize: Idle connections kept for each host
+    """
+
+    def __init__(self, maxsize=10):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._idle = defaultdict(list)
+
+    def send(self, rate_request, timeout):
+        """Send the request and return its :class:`RateResponse`. A
+        request which fails on a connection that was idle, and could have
+        been closed by the server meanwhile, is retried on another one.
+        """
+        parts = urlparse.urlsplit(rate_request.url)
+        key = (parts.scheme, parts.netloc)
+        path = (parts.path or '/') + (parts.query and '?' + parts.query)
+
+        while True:
+            connection, reused = self._get(key, timeout)
+            try:
+                connection.request(
+                    rate_request.method, path, rate_request.body,
+                    rate_request.headers
+                )
+                response = connection.getresponse()
+                body = response.read()
+            except socket.timeout as error:
+                connection.close()
+                return RateResponse(rate_request, error=error)
+            except (socket.error, httplib.HTTPException) as error:
+                connection.close()
+                if reused:
+                    continue
+                return RateResponse(rate_request, error=error)
+            if response.will_close:
+                connection.close()
+            else:
+                self._put(key, connection)
+            return RateResponse(
+                rate_request, response.status, dict(response.getheaders()),
+                body
+            )
+
+    def _get(self, key, timeout):
+        "Return an idle connection to the host, or a new one"
+        with self._lock:
+            idle = self._idle[key]
+            connection = idle and idle.pop() or None
+        if connection is None:
+            Connection = key[0] == 'https' and httplib.HTTPSConnection \
+                or httplib.HTTPConnection
+            return Connection(key[1], timeout=timeout), False
+        connection.timeout = timeout
+        connection.sock.settimeout(timeout)
+        return connection, True
+
+    def _put(self, key, connection):
+        with self._lock:
+            idle = self._idle[key]
+            if len(idle) < self.maxsize:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def clear(self):
+        "Close all the idle connections"
+        with self._lock:
+            idle, self._idle = self._idle, defaultdict(list)
+        for connections in idle.itervalues():
+            for connection in connections:
+                connection.close()
+
+
+#: The connections of this process
+connection_pool = ConnectionPool()
+
+
+class CarrierFetch(object):
+    """
+    The requests of a carrier method, each sent in its own thread as soon
+    as the fetch is created
+
+    :param requests: List of :class:`RateRequest`
+    :param timeout: Seconds the method may take, after which the requests
+                    which are still pending are given up on
+    :param pool: :class:`ConnectionPool` of the connections
+    """
+
+    def __init__(self, requests, timeout, pool=connection_pool):
+        self.requests = requests
+        self.deadline = time.time() + timeout
+        self._responses = [None] * len(requests)
+        self._threads = []
+        for index, rate_request in enumerate(requests):
+            thread = threading.Thread(
+                target=self._send, args=(
+                    pool, index, rate_request, rate_request.timeout or timeout
+                )
+            )
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _send(self, pool, index, rate_request, timeout):
+        self._responses[index] = pool.send(rate_request, timeout)
+
+    def wait(self):
+        """Wait until every request is done or the deadline, and return
+        the list of :class:`RateResponse` in the order of the requests
+        """
+        for thread in self._threads:
+            thread.join(max(self.deadline - time.time(), 0))
+        return [
+            response or RateResponse(
+                rate_request, error=socket.timeout('Deadline exceeded')
+            ) for rate_request, response in zip(
+                self.requests, self._responses
+            )
+        ]
+
+
+class CarrierRateMixin(object):
+    """
+    Mixin for the shipping method models whose rates are computed by the
+    rating API of a carrier. Such methods implement get_rate_requests and
+    parse_rate_responses instead of get_rate.
+
+    The time the requests of a method may take is its `rate_timeout`, or
+    `SHIPPING_CARRIER_TIMEOUT` in the application config (5 seconds by
+    default).
+    """
+
+    #: Seconds the requests of the method may take, see
+    #: NereidShipping.get_rate_timeout
+    rate_timeout = None
+
+    @classmethod
+    def get_rate(cls, queue, rate_responses=None, **kwargs):
+        """Put the options of the responses to the requests of the method
+        on the queue. NereidShipping sends the requests of all the carrier
+        methods of a quote at once, and passes the responses as
+        `rate_responses`. When called without them, the requests are sent
+        here.
+        """
+        if rate_responses is None:
+            Shipping = Pool().get('nereid.shipping')
+            rate_responses = CarrierFetch(
+                cls.get_rate_requests(**kwargs),
+                Shipping.get_rate_timeout(cls.__name__)
+            ).wait()
+        cls.parse_rate_responses(rate_responses, queue, **kwargs)
+
+    @classmethod
+    def get_rate_requests(cls, **kwargs):
+        """Return the list of :class:`RateRequest` to the API of the
+        carrier for the keyword arguments of get_rate. Called in the
+        transaction of the request.
+        """
+        return []
+
+    @classmethod
+    def parse_rate_responses(cls, responses, queue, **kwargs):
+        """Put the options of the list of :class:`RateResponse`, in the
+        order of the requests, on the queue. Responses which failed or
+        timed out have an `error`.
+        """
+        pass
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+    estimate
+
+    Shipping estimates precomputed for the product pages
+
+    :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) LTD
+    :license: GPLv3, see LICENSE for more details.
+"""
+from decimal import Decimal
+from bisect import bisect_left
+
+from nereid.globals import request
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool, PoolMeta
+
+from quote import QuoteContext
+
+__all__ = ['ShippingEstimate', 'Product']
+__poolmeta__ = PoolMeta
+
+
+class ShippingEstimate(ModelSQL, ModelView):
+    """
+    Nereid Shipping Estimate
+
+    The cheapest shipping option of a website to a country for carts in
+    representative buckets of total amount and weight. Only the buckets of
+    total amount where the option changes are stored, so the estimate of
+    a cart is the one of the highest bucket of total amount not above
+    its total amount. An estimate without an amount means that there is
+    no shipping option.
+    """
+    __name__ = 'nereid.shipping.estimate'
+
+    website = fields.Many2One(
+        'nereid.website', 'Website', required=True, readonly=True,
+        ondelete='CASCADE', select=True
+    )
+    country = fields.Many2One(
+        'country.country', 'Country', required=True, readonly=True,
+        ondelete='CASCADE', select=True
+    )
+    guest = fields.Boolean('Guest', readonly=True)
+    weight = fields.Float(
+        'Weight', readonly=True, help="Weight of the bucket in kilograms"
+    )
+    total_amount = fields.Float(
+        'Total Amount', readonly=True,
+        help="Lowest total amount of the bucket"
+    )
+    name = fields.Char('Name', readonly=True)
+    amount = fields.Numeric('Amount', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ShippingEstimate, cls).__setup__()
+        cls._order.insert(0, ('total_amount', 'DESC'))
+
+        #: The lowest total amount of each bucket
+        cls._amount_buckets = (0, 10, 25, 50, 100, 250, 500, 1000)
+
+        #: The highest weight in kilograms of each bucket. Heavier carts
+        #: are estimated with the last bucket.
+        cls._weight_buckets = (0.5, 1, 2, 5, 10, 25)
+
+    @classmethod
+    def refresh_estimates(cls):
+        """Compute the estimates of the websites whose shipping
+        configuration changed since they were last computed. Run by a cron
+        job.
+        """
+        Website = Pool().get('nereid.website')
+
+        websites = Website.search([('shipping_estimates_stale', '=', True)])
+        if websites:
+            cls.compute_estimates(websites)
+
+    @classmethod
+    def compute_estimates(cls, websites):
+        "Replace the estimates of the websites with new ones"
+        Website = Pool().get('nereid.website')
+
+        cls.delete(cls.search([('website', 'in', map(int, websites))]))
+        vlist = []
+        for website in websites:
+            for country in website.countries:
+                for guest in (False, True):
+                    for weight in cls._weight_buckets:
+                        vlist.extend(cls._compute_amount_buckets(
+                            website, country, guest, weight
+                        ))
+        cls.create(vlist)
+        Website.write(websites, {'shipping_estimates_stale': False})
+
+    @classmethod
+    def _compute_amount_buckets(cls, website, country, guest, weight):
+        """Return the values of the estimates of the buckets of total
+        amount where the cheapest option changes
+        """
+        vlist, previous = [], None
+        for total_amount in cls._amount_buckets:
+            option = cls._get_cheapest_option(
+                website, country, QuoteContext.from_snapshot(
+                    website.id, guest, Decimal(total_amount), weight, 1.0
+                )
+            )
+            result = option and (option.name, option.amount)
+            if result == previous:
+                continue
+            vlist.append({
+                'website': website.id,
+                'country': country.id,
+                'guest': guest,
+                'weight': weight,
+                'total_amount': total_amount,
+                'name': option and option.name,
+                'amount': option and Decimal(str(option.amount)),
+            })
+            previous = result
+        return vlist
+
+    @classmethod
+    def _get_cheapest_option(cls, website, country, quote_context):
+        """Return the cheapest option of the method models which can rate
+        without a request (those with a get_rate_options method), or None
+        """
+        Shipping = Pool().get('nereid.shipping')
+
+        options = []
+        for model in Shipping.get_method_models():
+            Method = Pool().get(model)
+            if hasattr(Method, 'get_rate_options'):
+                options.extend(Method.get_rate_options(
+                    website, quote_context, country.id,
+                    guest=quote_context.guest
+                ))
+        if options:
+            return min(options, key=lambda option: option.amount)
+
+    @classmethod
+    def get_estimate(cls, website, country, total_amount, weight=0.0,
+                     guest=False):
+        """Return the estimate of the cheapest shipping of a cart, or None
+        if there is no shipping option or no estimate yet.
+
+        :param website: ID of the website
+        :param country: ID of the destination country
+        :param total_amount: Total amount of the cart
+        :param weight: Weight of the cart in kilograms
+        :param guest: True if the estimate is for a guest user
+        """
+        buckets = cls._weight_buckets
+        estimates = cls.search([
+            ('website', '=', website),
+            ('country', '=', country),
+            ('guest', '=', guest),
+            ('weight', '=', buckets[
+                min(bisect_left(buckets, weight), len(buckets) - 1)
+            ]),
+            ('total_amount', '<=', float(total_amount)),
+        ], limit=1)
+        if estimates and estimates[0].amount is not None:
+            return estimates[0]
+
+
+class Product(ModelSQL, ModelView):
+    "Product"
+    __name__ = 'product.product'
+
+    def get_shipping_estimate(self, country):
+        """Return the :class:`ShippingEstimate` of shipping the product
+        alone to the country from the current website, or None. Could be
+        used in the templates of product pages.
+
+        :param country: ID of the destination country
+        """
+        Estimate = Pool().get('nereid.shipping.estimate')
+        SaleLine = Pool().get('sale.line')
+
+        return Estimate.get_estimate(
+            request.nereid_website.id, country, self.list_price,
+            SaleLine.get_unit_weight(self), guest=request.is_guest_user
+        )
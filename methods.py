@@ -7,22 +7,44 @@
     :copyright: (c) 2011-2013 by Openlabs Technologies & Consulting (P) LTD
     :license: GPLv3, see LICENSE for more details.
 """
+import csv
+from decimal import Decimal, InvalidOperation
+from collections import defaultdict
+
 from nereid.globals import request, session
 from trytond.model import ModelSQL, ModelView, fields
-from trytond.pyson import Eval
+from trytond.pyson import Eval, Id
 from trytond.pool import Pool, PoolMeta
+from trytond.cache import Cache
+from trytond.transaction import Transaction
+from trytond import backend
+
+from shipping import ShippingConfigMixin
+from plan import SlabIndex, ZipIndex, normalise_zip
+from quote import RateOption
 
 __all__ = [
     'FlatRateShipping', 'FreeShipping', 'ShippingTable', 'ShippingTableLine',
 ]
 __poolmeta__ = PoolMeta
 
+#: Columns of the CSV rate cards of shipping tables
+RATE_CARD_FIELDS = ('country', 'subdivision', 'zip', 'factor', 'price')
+
+#: Optional columns of the rate cards, of the zip rules of the lines
+RATE_CARD_ZIP_FIELDS = ('zip_match', 'zip_end')
 
-class FlatRateShipping(ModelSQL, ModelView):
+
+class FlatRateShipping(ShippingConfigMixin, ModelSQL, ModelView):
     "Nereid Flat Rate Shipping"
     __name__ = "nereid.shipping.method.flat"
 
-    shipping = fields.Many2One('nereid.shipping', 'Shipping', required=True)
+    #: Cost hint of computing a rate, see NereidShipping.get_rate_cost
+    rate_cost = 1
+
+    shipping = fields.Many2One(
+        'nereid.shipping', 'Shipping', required=True, select=True
+    )
     price = fields.Numeric('Price', required=True)
 
     @classmethod
@@ -33,139 +55,513 @@ class FlatRateShipping(ModelSQL, ModelView):
     @classmethod
     def get_rate(cls, queue, country, **kwargs):
         "Get the rate "
-        domain = [
-            ('shipping.available_countries', '=', country),
-            ('shipping.website', '=', request.nereid_website.id),
+        for option in cls.get_rate_options(
+                request.nereid_website, None, country,
+                guest=request.is_guest_user):
+            queue.put(option)
+
+    @classmethod
+    def get_rate_options(
+            cls, website, quote_context, country, subdivision=None,
+            zip=None, guest=False):
+        """Return the list of :class:`quote.RateOption` of the website for
+        the destination, without depending on the request, so that
+        estimates could be computed offline.
+
+        Every eligible rate is an option. The rates are browsed together,
+        so their fields and the names of their shippings are each read in
+        one query whatever their number.
+        """
+        Shipping = Pool().get('nereid.shipping')
+
+        plan = Shipping.get_rate_plan(website)
+        return [
+            RateOption(
+                rate.id, rate.shipping.name, float(rate.price), cls.__name__
+            ) for rate in cls.browse(plan.lookup(cls.__name__, country, guest))
         ]
-        if request.is_guest_user:
-            domain.append(('shipping.is_allowed_for_guest', '=', True))
-
-        rates = cls.search(domain)
-        if not rates:
-            return None
-
-        rate = rates[0]
-        queue.put({
-            'id': rate.id,
-            'name': rate.shipping.name,
-            'amount': float(rate.price)
-        })
-        return
 
 
-class FreeShipping(ModelSQL, ModelView):
+class FreeShipping(ShippingConfigMixin, ModelSQL, ModelView):
     "Nereid Free Shipping"
     __name__ = "nereid.shipping.method.free"
 
-    shipping = fields.Many2One('nereid.shipping', 'Shipping', required=True)
+    #: Cost hint of computing a rate, see NereidShipping.get_rate_cost
+    rate_cost = 2
+
+    shipping = fields.Many2One(
+        'nereid.shipping', 'Shipping', required=True, select=True
+    )
     minimum_order_value = fields.Numeric('Minimum Order Value')
 
     @classmethod
     def get_rate(cls, queue, country, **kwargs):
         "Free shipping if order value is above a certain limit"
-        Cart = Pool().get('nereid.cart')
-        domain = [
-            ('shipping.available_countries', '=', country),
-            ('shipping.website', '=', request.nereid_website.id),
-        ]
-        if 'user' not in session:
-            domain.append(('shipping.is_allowed_for_guest', '=', True))
+        Shipping = Pool().get('nereid.shipping')
 
-        rates = cls.search(domain)
-        if not rates:
-            return
+        quote_context = kwargs.get('quote_context') or \
+            Shipping.get_quote_context()
+        for option in cls.get_rate_options(
+                request.nereid_website, quote_context, country,
+                guest='user' not in session):
+            queue.put(option)
 
-        rate = rates[0]
-        cart = Cart.open_cart()
-        if cart.sale.total_amount >= rate.minimum_order_value:
-            queue.put({
-                'id': rate.id,
-                'name': rate.shipping.name,
-                'amount': 0.00,
-            })
-        return
+    @classmethod
+    def get_rate_options(
+            cls, website, quote_context, country, subdivision=None,
+            zip=None, guest=False):
+        """Return the list of :class:`quote.RateOption` of the website for
+        the destination and the cart of the :class:`quote.QuoteContext`,
+        without depending on the request.
+
+        Every eligible rate whose minimum order value the cart reaches is
+        an option.
+        """
+        Shipping = Pool().get('nereid.shipping')
+
+        plan = Shipping.get_rate_plan(website)
+        return [
+            RateOption(rate.id, rate.shipping.name, 0.00, cls.__name__)
+            for rate in cls.browse(plan.lookup(cls.__name__, country, guest))
+            if quote_context.total_amount >= rate.minimum_order_value
+        ]
 
 
-class ShippingTable(ModelSQL, ModelView):
+class ShippingTable(ShippingConfigMixin, ModelSQL, ModelView):
     "Nereid Shipping Table"
     __name__ = 'nereid.shipping.method.table'
 
-    shipping = fields.Many2One('nereid.shipping', 'Shipping', required=True)
+    #: Cost hint of computing a rate, see NereidShipping.get_rate_cost
+    rate_cost = 5
+
+    shipping = fields.Many2One(
+        'nereid.shipping', 'Shipping', required=True, select=True
+    )
     lines = fields.One2Many(
         'shipping.method.table.line', 'table', 'Table Lines')
     factor = fields.Selection([
         ('total_price', 'Total Price'),
-        #TODO: ('total_weight', 'Total Weight'),
-        #TODO: ('total_quantity', 'Total Quantity'),
+        ('total_weight', 'Total Weight'),
+        ('total_quantity', 'Total Quantity'),
     ], 'Factor', required=True)
+    weight_uom = fields.Many2One(
+        'product.uom', 'Weight Uom',
+        domain=[('category', '=', Id('product', 'uom_cat_weight'))],
+        states={
+            'invisible': Eval('factor') != 'total_weight',
+            'required': Eval('factor') == 'total_weight',
+        }, depends=['factor'],
+        help="Unit of the weights in the factor of the lines"
+    )
+
+    _slab_cache = Cache('nereid.shipping.method.table.slabs', context=False)
+    _zip_index_cache = Cache(
+        'nereid.shipping.method.table.zips', context=False
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(ShippingTable, cls).__setup__()
+        cls._error_messages.update({
+            'rate_card_columns': 'The rate card must have the columns: %s',
+            'rate_card_country': (
+                'Unknown country "%s" on row %d of the rate card.'
+            ),
+            'rate_card_subdivision': (
+                'Unknown subdivision "%s" of the country on row %d of the '
+                'rate card.'
+            ),
+            'rate_card_number': 'Invalid %s "%s" on row %d of the rate card.',
+        })
 
     @classmethod
     def default_model(cls):
         "Sets Self Name"
         return cls.__name__
 
+    @staticmethod
+    def default_weight_uom():
+        ModelData = Pool().get('ir.model.data')
+        return ModelData.get_id('product', 'uom_kilogram')
+
+    def get_factor_value(self, sale):
+        """Return the value of the factor of the table for the sale, which
+        is compared with the factor of the lines.
+
+        The weight and quantity are the totals maintained on the sale as
+        its lines change. The sale could also be a
+        :class:`quote.QuoteContext`.
+        """
+        Uom = Pool().get('product.uom')
+        ModelData = Pool().get('ir.model.data')
+
+        if self.factor == 'total_weight':
+            return Uom.compute_qty(
+                Uom(ModelData.get_id('product', 'uom_kilogram')),
+                sale.shipping_weight or 0.0, self.weight_uom, round=False
+            )
+        elif self.factor == 'total_quantity':
+            return sale.shipping_quantity or 0.0
+        return sale.total_amount
+
     @classmethod
     def get_rate(cls, queue, zip, subdivision, country, **kwargs):
         """Calculate the price of shipment based on factor, shipment address
-            and factor defined in table lines.
-
-        The filter logic might look a bit wierd, the loop basic is below
-
-           >>> p = [0, 1, 2, 3]
-           >>> for i in [None, -1, -2, -3]:
-           ...     p[:i] + [-x for x in p[i:] if i]
-           ...
-           [0,      1,      2,      3]
-           [0,      1,      2,     -3]
-           [0,      1,     -2,     -3]
-           [0,     -1,     -2,     -3]
-
-        Basically what the loop does is, it mutates the loop starting from
-        the end. The domain leaves are falsified in every iteration. So first
-        loop will be:
-            1: Actual Domain
-            2: Actual Domain[0:3] + [('zip', '=', False)]
-            3: ''[0:2] + [('subdivision', '=', False), ('zip', '=', False)]
-            4: ''[0:1] + [('country', '=', False), ...]
+        and factor defined in table lines.
+
+        The lines matching the address are looked up in the slab indexes
+        of the table, from the most specific match to the least specific
+        one. See :meth:`get_slab_indexes`.
+        """
+        Shipping = Pool().get('nereid.shipping')
+
+        quote_context = kwargs.get('quote_context') or \
+            Shipping.get_quote_context()
+        for option in cls.get_rate_options(
+                request.nereid_website, quote_context, country,
+                subdivision, zip, guest='user' not in session):
+            queue.put(option)
+
+    @classmethod
+    def get_rate_options(
+            cls, website, quote_context, country, subdivision=None,
+            zip=None, guest=False):
+        """Return the list of :class:`quote.RateOption` of the website for
+        the destination and the cart of the :class:`quote.QuoteContext`,
+        without depending on the request.
+
+        Every eligible table with a slab for the cart is an option. The
+        slab indexes of the tables which are not cached are built with a
+        single search of their lines.
+        """
+        Shipping = Pool().get('nereid.shipping')
+
+        plan = Shipping.get_rate_plan(website)
+        tables = cls.browse(plan.lookup(cls.__name__, country, guest))
+        slab_indexes = cls._get_slab_indexes([
+            (table.id, country, subdivision, zip) for table in tables
+        ])
+
+        options = []
+        for table in tables:
+            compared_value = table.get_factor_value(quote_context)
+            for slab_index in slab_indexes[
+                    (table.id, country, subdivision, zip)]:
+                amount = slab_index.find(compared_value)
+                if amount is not None:
+                    options.append(RateOption(
+                        table.id, table.shipping.name, amount, cls.__name__
+                    ))
+                    break
+        return options
+
+    @classmethod
+    def get_slab_indexes(cls, table, country, subdivision, zip):
+        """Return a tuple of :class:`plan.SlabIndex` of the lines of the
+        table matching the address, from the most specific match to the
+        least specific one. The indexes are cached until the configuration
+        changes.
+        """
+        key = (table.id, country, subdivision, zip)
+        return cls._get_slab_indexes([key])[key]
+
+    @classmethod
+    def _get_slab_indexes(cls, keys):
+        """Return a dictionary of the slab indexes of each (table ID,
+        country, subdivision, zip) key, like :meth:`get_slab_indexes`.
+        The indexes which are not cached are built with a single search
+        and cached.
+        """
+        result = dict((key, cls._slab_cache.get(key)) for key in keys)
+        missing = [key for key, value in result.iteritems() if value is None]
+        if missing:
+            for key, slab_indexes in \
+                    cls._find_slab_indexes(missing).iteritems():
+                result[key] = cls._slab_cache.set(key, slab_indexes)
+        return result
+
+    @classmethod
+    def prefetch_rates(cls, destinations):
+        """Build the slab indexes of the tables for all the destinations
+        of a batch quote, with a single search of the lines.
+
+        :param destinations: List of the keyword arguments of get_rate
+        """
+        Shipping = Pool().get('nereid.shipping')
+
+        plan = Shipping.get_rate_plan(request.nereid_website)
+        keys = set()
+        for destination in destinations:
+            country = destination.get('country')
+            for table_id in plan.lookup(
+                    cls.__name__, country, 'user' not in session):
+                keys.add((
+                    table_id, country, destination.get('subdivision'),
+                    destination.get('zip'),
+                ))
+        cls._get_slab_indexes(list(keys))
+
+    @classmethod
+    def _find_slab_indexes(cls, keys):
+        """Return a dictionary of the slab indexes of the lines matching
+        each (table ID, country, subdivision, zip) key, from the most
+        specific match to the least specific one. The levels of
+        specificity are lines with:
+
+            1: A zip rule matching the zip, of the country and either the
+               subdivision or no subdivision, see :class:`plan.ZipIndex`
+            2: The country and subdivision, and no zip
+            3: The country, and no subdivision or zip
+            4: No country, subdivision or zip
+
+        All the candidate lines are fetched in a single query and then
+        ranked in that order. The zip indexes which are not cached are
+        built and cached along the way.
         """
         Line = Pool().get('shipping.method.table.line')
-        Cart = Pool().get('nereid.cart')
 
-        domain = [
-            ('shipping.available_countries', '=', country),
-            ('shipping.website', '=', request.nereid_website.id),
-        ]
-        if 'user' not in session:
-            domain.append(('shipping.is_allowed_for_guest', '=', True))
+        zip_indexes = dict(
+            (key[:3], cls._zip_index_cache.get(key[:3])) for key in keys
+        )
+        zip_keys = set(
+            key for key, zip_index in zip_indexes.iteritems()
+            if zip_index is None
+        )
+        domain = cls._get_levels_domain(set(
+            level for key in keys for level in cls._get_levels(*key[1:3])
+        ))
+        if zip_keys:
+            domain = ['OR', domain, cls._get_zip_rules_domain(zip_keys)]
+        lines = Line.search([
+            ('table', 'in', list(set(key[0] for key in keys))),
+            domain,
+        ], order=[('factor', 'DESC')])
+
+        lines_by_table = defaultdict(list)
+        for line in lines:
+            lines_by_table[line.table.id].append(line)
+
+        for key in zip_keys:
+            table_id, country, subdivision = key
+            zip_indexes[key] = cls._zip_index_cache.set(
+                key, ZipIndex.from_lines([
+                    line for line in lines_by_table[table_id]
+                    if line.zip and line.country
+                    and line.country.id == country and (
+                        not line.subdivision
+                        or line.subdivision.id == subdivision
+                    )
+                ])
+            )
+
+        result = {}
+        for table_id, country, subdivision, zip in keys:
+            zip_index = zip_indexes[(table_id, country, subdivision)]
+            result[(table_id, country, subdivision, zip)] = (
+                zip_index.find(zip) if zip else ()
+            ) + tuple(
+                SlabIndex.from_lines(matches) for matches in cls._rank_lines(
+                    lines_by_table[table_id],
+                    cls._get_levels(country, subdivision)
+                )
+            )
+        return result
+
+    @staticmethod
+    def _get_levels(country, subdivision):
+        """Return the (country, subdivision) of the lines without a zip
+        matching the address at each level of specificity, see
+        :meth:`_find_slab_indexes`
+        """
+        levels = []
+        for level in [(country, subdivision), (country, None), (None, None)]:
+            if level not in levels:
+                levels.append(level)
+        return levels
+
+    @staticmethod
+    def _get_levels_domain(levels):
+        "Return the domain of the lines without a zip of any of the levels"
+        return ['OR'] + [[
+            ('country', '=', level[0]),
+            ('subdivision', '=', level[1]),
+            ('zip', '=', None),
+        ] for level in levels]
+
+    @staticmethod
+    def _get_zip_rules_domain(zip_keys):
+        """Return the domain of the lines with a zip rule of any of the
+        (table ID, country, subdivision) keys
+        """
+        return ['OR'] + [[
+            ('table', '=', table_id),
+            ('country', '=', country),
+            ['OR',
+                ('subdivision', '=', subdivision),
+                ('subdivision', '=', None),
+            ],
+            ('zip', '!=', None),
+        ] for table_id, country, subdivision in zip_keys]
+
+    @staticmethod
+    def _rank_lines(lines, levels):
+        """Yield the lists of the lines without a zip of each level, in the
+        order of the levels, skipping the levels without any line
+        """
+        ranked = [((
+            line.country.id if line.country else None,
+            line.subdivision.id if line.subdivision else None,
+        ), line) for line in lines if not line.zip]
+        for level in levels:
+            matches = [line for key, line in ranked if key == level]
+            if matches:
+                yield matches
 
-        tables = cls.search(domain)
-        if not tables:
-            return
+    @classmethod
+    def import_lines(cls, table, stream, replace=False, chunk_size=1000):
+        """Import the lines of the table from a rate card, a CSV file with
+        a header row and the columns of RATE_CARD_FIELDS, and optionally
+        of RATE_CARD_ZIP_FIELDS. Countries and subdivisions are given by
+        their codes, and could be left empty like the zip. The zip is
+        matched exactly unless the zip_match column says otherwise.
+
+        The file is read and the lines are created in chunks, so that
+        memory does not grow with the size of the file. As it is done in
+        the transaction, the import and the replacement of the existing
+        lines happen entirely or not at all.
+
+        :param table: Active record of the table
+        :param stream: File like object of the rate card
+        :param replace: True if the existing lines of the table should be
+                        replaced by the imported ones
+        :param chunk_size: Number of lines created at once
+        :return: The number of lines imported
+        """
+        Line = Pool().get('shipping.method.table.line')
 
-        cart = Cart.open_cart()
-        compared_value = cart.sale.total_amount
+        reader = csv.DictReader(stream)
+        if not set(RATE_CARD_FIELDS) <= set(reader.fieldnames or []):
+            cls.raise_user_error(
+                'rate_card_columns', ', '.join(RATE_CARD_FIELDS)
+            )
+        if replace:
+            Line.delete(Line.search([('table', '=', table.id)]))
+
+        countries, subdivisions = cls._get_code_maps()
+        count, vlist = 0, []
+        for row in reader:
+            vlist.append(cls._get_rate_card_values(
+                table, row, reader.line_num, countries, subdivisions
+            ))
+            if len(vlist) >= chunk_size:
+                Line.create(vlist)
+                count, vlist = count + len(vlist), []
+        if vlist:
+            Line.create(vlist)
+        return count + len(vlist)
 
-        # compared value under an IF
+    @classmethod
+    def export_lines(cls, table, stream, chunk_size=1000):
+        """Write the lines of the table to the stream as a rate card which
+        could be imported with :meth:`import_lines`. The lines are read in
+        chunks, so that memory does not grow with the size of the table.
 
-        domain = [
-            ('table', '=', tables[0].id),       # 0
-            ('country', '=', country),          # 1
-            ('subdivision', '=', subdivision),  # 2
-            ('zip', '=', zip),                  # 3
-        ]
-        # Try finding lines with max => min match
-        # Read the doc string for the logic here
-        for index in (None, -1, -2, -3):
-            search_domain = domain[:index] + [
-                (l[0], '=', None) for l in domain[index:] if index
-            ]
-            lines = Line.search(
-                search_domain, order=[('factor', 'DESC')])
-            if lines:
-                result = cls.find_slab(lines, compared_value)
-                if result:
-                    queue.put(result)
-                    break
+        :return: The number of lines exported
+        """
+        Line = Pool().get('shipping.method.table.line')
+
+        countries, subdivisions = cls._get_code_maps()
+        countries = dict((id_, code) for code, id_ in countries.iteritems())
+        subdivisions = dict(
+            (id_, code) for (country, code), id_ in subdivisions.iteritems()
+        )
+
+        writer = csv.writer(stream)
+        writer.writerow(RATE_CARD_FIELDS + RATE_CARD_ZIP_FIELDS)
+        count, last_id = 0, 0
+        while True:
+            lines = Line.search_read([
+                ('table', '=', table.id),
+                ('id', '>', last_id),
+            ], limit=chunk_size, order=[('id', 'ASC')], fields_names=[
+                'country', 'subdivision', 'zip', 'factor', 'price',
+                'zip_match', 'zip_end',
+            ])
+            if not lines:
+                return count
+            for line in lines:
+                writer.writerow([
+                    countries.get(line['country'], ''),
+                    subdivisions.get(line['subdivision'], ''),
+                    (line['zip'] or '').encode('utf-8'),
+                    repr(line['factor']),
+                    str(line['price']),
+                    line['zip_match'],
+                    (line['zip_end'] or '').encode('utf-8'),
+                ])
+            count += len(lines)
+            last_id = lines[-1]['id']
+
+    @staticmethod
+    def _get_code_maps():
+        """Return the maps of the codes of the countries to their IDs, and
+        of the (country, code) of the subdivisions to their IDs
+        """
+        Country = Pool().get('country.country')
+        Subdivision = Pool().get('country.subdivision')
+
+        countries = dict(
+            (country['code'].upper(), country['id'])
+            for country in Country.search_read([], fields_names=['code'])
+            if country['code']
+        )
+        subdivisions = dict(
+            ((subdivision['country'], subdivision['code'].upper()),
+                subdivision['id'])
+            for subdivision in Subdivision.search_read(
+                [], fields_names=['country', 'code']
+            )
+        )
+        return countries, subdivisions
+
+    @classmethod
+    def _get_rate_card_values(
+            cls, table, row, line_num, countries, subdivisions):
+        """Return the values of the line of the table for a row of a rate
+        card, validating and resolving the codes of the row.
+        """
+        country = subdivision = None
+        code = (row['country'] or '').strip().upper()
+        if code:
+            country = countries.get(code)
+            if country is None:
+                cls.raise_user_error('rate_card_country', (code, line_num))
+        code = (row['subdivision'] or '').strip().upper()
+        if code:
+            subdivision = subdivisions.get((country, code))
+            if subdivision is None:
+                cls.raise_user_error(
+                    'rate_card_subdivision', (code, line_num)
+                )
+
+        values = {
+            'table': table.id,
+            'country': country,
+            'subdivision': subdivision,
+            'zip': (row['zip'] or '').strip().decode('utf-8') or None,
+            'zip_match': (row.get('zip_match') or '').strip() or 'exact',
+            'zip_end': (
+                (row.get('zip_end') or '').strip().decode('utf-8') or None
+            ),
+        }
+        for name, type_ in (('factor', float), ('price', Decimal)):
+            try:
+                values[name] = type_((row[name] or '').strip())
+            except (ValueError, InvalidOperation):
+                cls.raise_user_error(
+                    'rate_card_number', (name, row[name], line_num)
+                )
+        return values
 
     @classmethod
     def find_slab(cls, lines, compared_value):
@@ -176,28 +572,96 @@ class ShippingTable(ModelSQL, ModelView):
         The lines are assumed to be sorted on the basis of decreasing
         factor
         """
-        for line in lines:
-            if float(compared_value) >= float(line.factor):
-                return {
-                    'id': line.table.id,
-                    'name': line.table.shipping.name,
-                    'amount': float(line.price),
-                }
+        amount = SlabIndex.from_lines(lines).find(compared_value)
+        if amount is not None:
+            return {
+                'id': lines[0].table.id,
+                'name': lines[0].table.shipping.name,
+                'amount': amount,
+            }
 
 
-class ShippingTableLine(ModelSQL, ModelView):
+class ShippingTableLine(ShippingConfigMixin, ModelSQL, ModelView):
     "Shipping Table Line"
     __name__ = 'shipping.method.table.line'
 
-    country = fields.Many2One('country.country', 'Country')
+    country = fields.Many2One('country.country', 'Country', select=True)
     subdivision = fields.Many2One(
         'country.subdivision', 'Subdivision',
         domain=[('country', '=', Eval('country'))],
-        depends=['country']
+        depends=['country'], select=True
     )
     zip = fields.Char('ZIP')
+    zip_match = fields.Selection([
+        ('exact', 'Exact'),
+        ('prefix', 'Prefix'),
+        ('range', 'Range'),
+    ], 'ZIP Match', required=True, help="How the ZIP of the address is "
+        "matched: equal to the ZIP, starting with the ZIP, or from the ZIP "
+        "to the ZIP End")
+    zip_end = fields.Char(
+        'ZIP End', states={
+            'invisible': Eval('zip_match') != 'range',
+            'required': Eval('zip_match') == 'range',
+        }, depends=['zip_match'], help="Last ZIP (inclusive) of the range"
+    )
     factor = fields.Float(
         'Factor', required=True, help="Value (inclusive) and above"
     )
     price = fields.Numeric('Price', required=True)
     table = fields.Many2One('nereid.shipping.method.table', 'Shipping Table')
+
+    _config_eligibility = False
+
+    @classmethod
+    def __setup__(cls):
+        super(ShippingTableLine, cls).__setup__()
+        cls._error_messages.update({
+            'zip_rule_required': (
+                'A ZIP is required to match the ZIP by prefix or range.'
+            ),
+            'invalid_zip_range': (
+                'The ZIP range from "%s" to "%s" must be digits of the same '
+                'length, in increasing order.'
+            ),
+        })
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(ShippingTableLine, cls).__register__(module_name)
+
+        # The lines of a table are looked up by the address
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['table', 'country', 'subdivision', 'zip'], 'add')
+
+    @staticmethod
+    def default_zip_match():
+        return 'exact'
+
+    @classmethod
+    def validate(cls, lines):
+        super(ShippingTableLine, cls).validate(lines)
+        for line in lines:
+            line.check_zip_rule()
+
+    def check_zip_rule(self):
+        "Check that the zip rule could be indexed"
+        if self.zip_match == 'exact':
+            return
+        zip, zip_end = normalise_zip(self.zip), normalise_zip(self.zip_end)
+        if not zip:
+            self.raise_user_error('zip_rule_required')
+        if self.zip_match == 'range' and not (
+                zip.isdigit() and zip_end.isdigit()
+                and len(zip) == len(zip_end) and zip <= zip_end):
+            self.raise_user_error('invalid_zip_range', (zip, zip_end))
+
+    @classmethod
+    def get_config_websites(cls, records):
+        return set(
+            record.table.shipping.website.id for record in records
+            if record.table and record.table.shipping.website
+        )
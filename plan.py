@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+    plan
+
+    Compiled, read only views of the shipping configuration which are
+    used to answer quotes without searching the database.
+
+    :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) LTD
+    :license: GPLv3, see LICENSE for more details.
+"""
+from array import array
+from bisect import bisect_right
+from collections import defaultdict
+
+__all__ = ['RatePlan', 'SlabIndex', 'ZipIndex']
+
+
+class RatePlan(object):
+    """
+    The shipping method records of a website indexed by the destination
+    country and the eligibility of guest users.
+
+    A plan is immutable once compiled, so that it could be shared between
+    requests and threads.
+    """
+    __slots__ = ('website', '_index', '_models')
+
+    def __init__(self, website, index):
+        self.website = website
+        self._index = index
+
+        # The models which have records for each country and guest flag
+        models = defaultdict(set)
+        for model, country, guest in index:
+            models[country, guest].add(model)
+        self._models = dict(
+            (key, frozenset(value)) for key, value in models.iteritems()
+        )
+
+    @classmethod
+    def compile(cls, website, eligibility):
+        """Compile a plan for the website
+
+        :param website: ID of the website
+        :param eligibility: List of dictionaries of the
+                            nereid.shipping.eligibility records of the
+                            website, with the keys `country`,
+                            `guest_allowed`, `method_model` and
+                            `method_id`, in the order in which the methods
+                            should be offered
+        """
+        index = defaultdict(list)
+        for row in eligibility:
+            key = (row['method_model'], row['country'])
+            index[key + (False, )].append(row['method_id'])
+            if row['guest_allowed']:
+                index[key + (True, )].append(row['method_id'])
+        return cls(website, dict(
+            (key, tuple(ids)) for key, ids in index.iteritems()
+        ))
+
+    def lookup(self, model, country, guest=False):
+        """Return a tuple of the IDs of the records of the model which
+        ship to the country.
+
+        :param model: Name of the shipping method model
+        :param country: ID of the destination country
+        :param guest: True if only the records allowed for guests should
+                      be returned
+        """
+        return self._index.get((model, country, bool(guest)), ())
+
+    def models(self, country, guest=False):
+        """Return the frozenset of the names of the models which have
+        records that ship to the country.
+
+        :param country: ID of the destination country
+        :param guest: True if only the records allowed for guests should
+                      count
+        """
+        return self._models.get((country, bool(guest)), frozenset())
+
+
+class SlabIndex(object):
+    """
+    The slabs of a set of shipping table lines, as the sorted factors
+    (breakpoints) and the prices of each slab in parallel arrays. The slab
+    of a value is found with a binary search.
+    """
+    __slots__ = ('factors', 'prices')
+
+    def __init__(self, factors, prices):
+        self.factors = array('d', factors)
+        self.prices = array('d', prices)
+
+    @classmethod
+    def from_lines(cls, lines):
+        """Build an index from the shipping.method.table.line records
+
+        :param lines: List of lines sorted on the basis of decreasing
+                      factor
+        """
+        # Walk the lines in reverse, so that when factors are equal the
+        # first line wins like it would in a scan of the sorted lines
+        lines = lines[::-1]
+        return cls(
+            (line.factor for line in lines),
+            (float(line.price) for line in lines),
+        )
+
+    def find(self, value):
+        """Return the price of the slab with the highest factor that is
+        less than or equal to the value, or None if the value is below
+        every slab.
+        """
+        position = bisect_right(self.factors, float(value))
+        if position:
+            return self.prices[position - 1]
+
+
+def normalise_zip(zip):
+    "Return the zip as it is compared by the zip rules"
+    return (zip or '').strip().upper()
+
+
+def range_prefixes(start, end):
+    """Return the prefixes which together match exactly the zips from
+    start to end (inclusive), which are digits of the same length. For
+    example the range 68190 to 68299 is matched by the prefixes 6819 and
+    682.
+    """
+    if start == '0' * len(start) and end == '9' * len(end):
+        return ['']
+    first, last, rest = start[0], end[0], len(start) - 1
+    if first == last:
+        return [first + p for p in range_prefixes(start[1:], end[1:])]
+    return [first + p for p in range_prefixes(start[1:], '9' * rest)] + [
+        str(digit) for digit in xrange(int(first) + 1, int(last))
+    ] + [last + p for p in range_prefixes('0' * rest, end[1:])]
+
+
+class _ZipNode(object):
+    __slots__ = ('children', 'prefix', 'exact')
+
+    def __init__(self):
+        self.children = {}
+        self.prefix = []
+        self.exact = []
+
+
+class ZipIndex(object):
+    """
+    The zip rules of the shipping table lines of a country, in a trie of
+    the characters of the zips, so that the rules matching a zip are found
+    in the time of a walk down the characters of the zip. Ranges are
+    stored as the prefixes which cover them.
+
+    The rules matching a zip are ranked from the most specific to the
+    least specific one: exact zips, then prefixes from the longest to the
+    shortest, then ranges from the narrowest to the widest. Rules of the
+    subdivision rank before the same rules of the whole country.
+    """
+    __slots__ = ('_root', )
+
+    def __init__(self):
+        self._root = _ZipNode()
+
+    @classmethod
+    def from_lines(cls, lines):
+        """Build an index from the shipping.method.table.line records with
+        a zip. The lines of each rule make up a :class:`SlabIndex`.
+
+        :param lines: List of lines sorted on the basis of decreasing
+                      factor
+        """
+        rules = {}
+        for line in lines:
+            rule = (
+                line.zip_match, normalise_zip(line.zip),
+                normalise_zip(line.zip_end), line.subdivision is None,
+            )
+            rules.setdefault(rule, []).append(line)
+
+        index = cls()
+        for (match, zip, zip_end, country_wide), rule_lines in \
+                rules.iteritems():
+            slab_index = SlabIndex.from_lines(rule_lines)
+            if match == 'prefix':
+                index._add(zip, 'prefix', (
+                    (1, -len(zip), country_wide), slab_index
+                ))
+            elif match == 'range':
+                entry = ((2, int(zip_end) - int(zip), country_wide), slab_index)
+                for prefix in range_prefixes(zip, zip_end):
+                    index._add(prefix, 'prefix', entry)
+            else:
+                index._add(zip, 'exact', ((0, 0, country_wide), slab_index))
+        return index
+
+    def _add(self, prefix, kind, entry):
+        node = self._root
+        for char in prefix:
+            node = node.children.setdefault(char, _ZipNode())
+        getattr(node, kind).append(entry)
+
+    def find(self, zip):
+        """Return a tuple of the :class:`SlabIndex` of the rules matching
+        the zip, from the most specific rule to the least specific one.
+        """
+        node, entries = self._root, list(self._root.prefix)
+        for char in normalise_zip(zip):
+            node = node.children.get(char)
+            if node is None:
+                break
+            entries.extend(node.prefix)
+        else:
+            entries.extend(node.exact)
+        entries.sort(key=lambda entry: entry[0])
+        return tuple(slab_index for rank, slab_index in entries)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+    quote
+
+    The state of the cart shared by the shipping methods of a quote
+
+    :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) LTD
+    :license: GPLv3, see LICENSE for more details.
+"""
+from decimal import Decimal
+from collections import namedtuple
+
+__all__ = ['QuoteContext', 'RateOption', 'RateCollector']
+
+
+class QuoteContext(object):
+    """
+    The cart of a quote, loaded once and passed to the get_rate method of
+    every shipping method as the `quote_context` keyword argument.
+
+    It only holds plain values, so that it could be used from the threads
+    of the concurrent rate computation. The totals are named like the
+    fields of the sale, so that it could be used in place of the sale.
+
+    :param website: ID of the website
+    :param guest: True if the quote is for a guest user
+    :param sale_id: ID of the sale of the cart, or None if there is none
+    :param total_amount: Total amount of the sale
+    :param shipping_weight: Total weight of the sale in kilograms
+    :param shipping_quantity: Total quantity of the sale
+    :param fingerprint: Hashable value which changes with the cart
+    """
+    __slots__ = (
+        'website', 'guest', 'sale_id', 'total_amount', 'shipping_weight',
+        'shipping_quantity', 'fingerprint',
+    )
+
+    def __init__(self, website, guest, sale_id=None,
+                 total_amount=Decimal('0'), shipping_weight=0.0,
+                 shipping_quantity=0.0, fingerprint=None):
+        self.website = website
+        self.guest = guest
+        self.sale_id = sale_id
+        self.total_amount = total_amount
+        self.shipping_weight = shipping_weight
+        self.shipping_quantity = shipping_quantity
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def from_sale(cls, website, guest, sale):
+        """Build the context of a quote for the sale of a cart
+
+        :param website: ID of the website
+        :param guest: True if the quote is for a guest user
+        :param sale: The sale.sale record of the cart or None
+        """
+        if sale is None:
+            return cls(website, guest)
+        return cls(
+            website, guest, sale.id,
+            total_amount=sale.total_amount,
+            shipping_weight=sale.shipping_weight or 0.0,
+            shipping_quantity=sale.shipping_quantity or 0.0,
+            fingerprint=(
+                sale.id, sale.write_date, sale.total_amount,
+                sale.shipping_weight, sale.shipping_quantity,
+            ),
+        )
+
+    @classmethod
+    def from_snapshot(cls, website, guest, total_amount, shipping_weight,
+                      shipping_quantity):
+        """Build the context of a quote for the totals of a cart sent by
+        the client, instead of a sale
+
+        :param website: ID of the website
+        :param guest: True if the quote is for a guest user
+        :param total_amount: Total amount of the cart
+        :param shipping_weight: Total weight of the cart in kilograms
+        :param shipping_quantity: Total quantity of the cart
+        """
+        return cls(
+            website, guest,
+            total_amount=total_amount,
+            shipping_weight=shipping_weight,
+            shipping_quantity=shipping_quantity,
+            fingerprint=(
+                'snapshot', total_amount, shipping_weight, shipping_quantity
+            ),
+        )
+
+
+class RateOption(namedtuple('RateOption', 'id name amount model')):
+    """
+    A shipping option quoted by a method: the ID of the method record, the
+    name to display, the estimated amount and the name of the method
+    model. Being an immutable tuple, options could be shared between
+    requests and threads without copying them.
+    """
+    __slots__ = ()
+
+    def __new__(cls, id, name, amount, model=None):
+        return super(RateOption, cls).__new__(cls, id, name, amount, model)
+
+    @classmethod
+    def from_dict(cls, option, model=None):
+        """Build an option from the dictionary of the form documented in
+        NereidShipping._get_available_methods
+        """
+        return cls(
+            option['id'], option['name'], option['amount'],
+            option.get('model', model)
+        )
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'amount': self.amount,
+            'model': self.model,
+        }
+
+
+class RateCollector(object):
+    """
+    Collects the options put by the get_rate method of a method model. It
+    is passed to get_rate as the `queue`, in place of a Queue.Queue, and
+    does not lock as the options of a method are collected in the thread
+    which runs it.
+
+    Methods could put :class:`RateOption` instances, or dictionaries as
+    documented in NereidShipping._get_available_methods.
+
+    :param model: Name of the method model, set on the options which do not
+                  have one
+    """
+    __slots__ = ('model', 'options')
+
+    def __init__(self, model=None):
+        self.model = model
+        self.options = []
+
+    def put(self, option, block=True, timeout=None):
+        if not isinstance(option, RateOption):
+            option = RateOption.from_dict(option, self.model)
+        elif option.model is None:
+            option = option._replace(model=self.model)
+        self.options.append(option)
+
+    def put_nowait(self, option):
+        self.put(option)
+
+    def qsize(self):
+        return len(self.options)
+
+    def empty(self):
+        return not self.options
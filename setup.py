@@ -42,6 +42,27 @@ class XmlTests(Command):
         cov.xml_report(outfile="coverage.xml")
 
 
+class Benchmark(Command):
+    """Runs the benchmarks of the shipping quote path and saves the
+    results to benchmark-results.json, see tests/benchmark_shipping.py
+    """
+    description = "Run the benchmarks"
+
+    user_options = []
+
+    def initialize_options(self):
+        pass
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        import unittest
+        from tests.benchmark_shipping import suite, write_results
+        unittest.TextTestRunner(verbosity=2).run(suite())
+        write_results()
+
+
 class RunAudit(Command):
     """Audits source code using PyFlakes for following issues:
         - Names which are used but not defined or used before they are defined.
@@ -150,6 +171,7 @@ setup(
     test_suite='tests.suite',
     cmdclass={
         'xmltests': XmlTests,
+        'benchmark': Benchmark,
         'audit': RunAudit,
     },
     test_loader='trytond.test_loader:Loader',
@@ -5,22 +5,109 @@
     :copyright: (c) 2011-2013 by Openlabs Technologies & Consulting (P) LTD
     :license: GPLv3, see LICENSE for more details.
 """
-from Queue import Queue
+import json
+import time
+import threading
+from uuid import uuid4
+from hashlib import sha1
+from Queue import Queue, Empty
 from decimal import Decimal
+from collections import defaultdict
+from contextlib import closing, contextmanager
 
+from sql import Cast, Null
+from sql.functions import Round
+from sql.conditionals import Coalesce
+
+from flask import stream_with_context, has_request_context
+from itsdangerous import (
+    URLSafeTimedSerializer, BadSignature, constant_time_compare
+)
+from flask.globals import _app_ctx_stack
 from nereid import abort, jsonify
-from nereid.globals import request, session, current_app
+from nereid.globals import request, session, current_app, _request_ctx_stack
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+from trytond.cache import Cache
+from trytond import backend
+
+from plan import RatePlan
+from cache import SharedCache
+from quote import QuoteContext, RateOption, RateCollector
+from stats import rate_stats
+from carrier import CarrierFetch
 
 __all__ = [
     'NereidShipping', 'DefaultCheckout', 'WebsiteShipping', 'Website',
-    'AvailableCountries', 'SaleLine',
+    'AvailableCountries', 'Sale', 'SaleLine', 'Template',
+    'ShippingConfigMixin', 'ShippingEligibility',
 ]
 __poolmeta__ = PoolMeta
 
 
-class NereidShipping(ModelSQL, ModelView):
+def clear_record_cache(Model, ids):
+    """Clear the records of the model from the caches of the transaction
+    after they were updated directly in the database.
+    """
+    Transaction().counter += 1
+    for cache in Transaction().cursor.cache.itervalues():
+        if Model.__name__ in cache:
+            for id_ in ids:
+                if id_ in cache[Model.__name__]:
+                    cache[Model.__name__][id_].clear()
+
+
+class ShippingConfigMixin(object):
+    """
+    Mixin for the models which make up the shipping configuration. The
+    caches compiled from the configuration are cleared, and the websites
+    whose configuration changed are marked as such, whenever a record is
+    created, written or deleted.
+    """
+
+    #: False if the records have no effect on which methods ship where,
+    #: so that the eligibility of the websites need not be rebuilt
+    _config_eligibility = True
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(ShippingConfigMixin, cls).create(vlist)
+        Pool().get('nereid.shipping').config_changed(
+            cls.get_config_websites(records), cls._config_eligibility
+        )
+        return records
+
+    @classmethod
+    def write(cls, records, values, *args):
+        all_records = records + sum(args[::2], [])
+        websites = cls.get_config_websites(all_records)
+        super(ShippingConfigMixin, cls).write(records, values, *args)
+        Pool().get('nereid.shipping').config_changed(
+            websites | cls.get_config_websites(cls.browse(all_records)),
+            cls._config_eligibility
+        )
+
+    @classmethod
+    def delete(cls, records):
+        websites = cls.get_config_websites(records)
+        super(ShippingConfigMixin, cls).delete(records)
+        Pool().get('nereid.shipping').config_changed(
+            websites, cls._config_eligibility
+        )
+
+    @classmethod
+    def get_config_websites(cls, records):
+        """Return the set of the IDs of the websites whose configuration
+        the records are a part of
+        """
+        return set(
+            record.shipping.website.id for record in records
+            if record.shipping and record.shipping.website
+        )
+
+
+class NereidShipping(ShippingConfigMixin, ModelSQL, ModelView):
     "Nereid Shipping"
     __name__ = "nereid.shipping"
 
@@ -31,7 +118,145 @@ class NereidShipping(ModelSQL, ModelView):
         'nereid.shipping-country.country',
         'shipping', 'country', 'Countries Available'
     )
-    website = fields.Many2One('nereid.website', 'Website')
+    website = fields.Many2One('nereid.website', 'Website', select=True)
+
+    _method_models_cache = Cache(
+        'nereid.shipping.method_models', context=False
+    )
+    _rate_plan_cache = SharedCache('nereid.shipping.rate_plan')
+    _quote_cache = SharedCache('nereid.shipping.quote')
+
+    @classmethod
+    def __setup__(cls):
+        super(NereidShipping, cls).__setup__()
+
+        #: Names of the models, other than the nereid.shipping.* models
+        #: which are found automatically, that provide shipping rates.
+        #: Use :meth:`register_rate_provider` to add to this list.
+        cls._rate_providers = []
+
+    @classmethod
+    def __post_setup__(cls):
+        super(NereidShipping, cls).__post_setup__()
+
+        # The pool is set up again whenever modules are installed or
+        # updated, and modules providing shipping methods could have been,
+        # so discover the method models again
+        cls._method_models_cache.clear()
+
+    @classmethod
+    def register_rate_provider(cls, model_name):
+        """Register a model with a get_rate method as a provider of
+        shipping rates. This is only required for models whose name does
+        not start with `nereid.shipping.`
+
+        :param model_name: Name of the model in the pool
+        """
+        if model_name not in cls._rate_providers:
+            cls._rate_providers.append(model_name)
+
+    @classmethod
+    def get_method_models(cls):
+        """Return the names of the models which provide shipping rates.
+
+        The models named nereid.shipping.* which have a get_rate method
+        are looked up in ir.model only once per database and the result is
+        cached until a module is installed or updated.
+        """
+        method_models = cls._method_models_cache.get(None)
+        if method_models is None:
+            pool = Pool()
+            Model = pool.get('ir.model')
+            method_models = cls._method_models_cache.set(None, tuple(
+                model.model for model in Model.search(
+                    [('model', 'ilike', 'nereid.shipping.%')]
+                ) if hasattr(pool.get(model.model), 'get_rate')
+            ))
+        return list(method_models) + [
+            model for model in cls._rate_providers
+            if model not in method_models
+        ]
+
+    @classmethod
+    def get_config_websites(cls, records):
+        return set(
+            record.website.id for record in records if record.website
+        )
+
+    @classmethod
+    def config_changed(cls, websites, eligibility=True):
+        """Called whenever the shipping configuration of the websites
+        changes. Rebuilds the eligibility of the websites, clears the
+        caches compiled from the configuration and bumps the version of
+        the configuration of the websites, which invalidates their shared
+        caches and marks their shipping estimates as stale.
+
+        :param websites: IDs of the websites
+        :param eligibility: False if the change has no effect on which
+                            methods ship where
+        """
+        Website = Pool().get('nereid.website')
+        Eligibility = Pool().get('nereid.shipping.eligibility')
+
+        if websites and eligibility:
+            Eligibility.rebuild(list(websites))
+        cls.clear_config_cache()
+        if websites:
+            Website.bump_shipping_config_version(list(websites))
+
+    @classmethod
+    def clear_config_cache(cls):
+        """Clear everything compiled from the shipping configuration.
+        Called whenever the configuration changes.
+        """
+        Table = Pool().get('nereid.shipping.method.table')
+
+        cls._rate_plan_cache.clear()
+        cls._quote_cache.clear()
+        Table._slab_cache.clear()
+        Table._zip_index_cache.clear()
+
+    @classmethod
+    def get_rate_plan(cls, website):
+        """Return the :class:`plan.RatePlan` of the website, compiling it
+        if the configuration changed since it was last compiled.
+
+        :param website: Active record of the nereid.website
+        """
+        version = cls.get_config_version(website.id)
+        plan = cls._rate_plan_cache.get(website.id, version, None)
+        if plan is None:
+            plan = cls._rate_plan_cache.set(
+                website.id, version, None, cls._compile_rate_plan(website)
+            )
+        return plan
+
+    @staticmethod
+    def get_config_version(website):
+        """Return the version of the shipping configuration of the website
+        (ID), under which its caches are kept. It is made of the counter
+        and the stamp of the configuration, so that it is never reused,
+        and is read with the website record, once per transaction.
+        """
+        Website = Pool().get('nereid.website')
+        website = Website(website)
+        return '%s.%s' % (
+            website.shipping_config_version, website.shipping_config_stamp
+        )
+
+    @classmethod
+    def _compile_rate_plan(cls, website):
+        """Compile the rate plan of the website from its
+        nereid.shipping.eligibility records.
+        """
+        Eligibility = Pool().get('nereid.shipping.eligibility')
+
+        return RatePlan.compile(website.id, Eligibility.search_read(
+            [('website', '=', website.id)], order=[('method_id', 'ASC')],
+            fields_names=[
+                'country', 'guest_allowed', 'method_model', 'method_id'
+            ]
+        ))
 
     @staticmethod
     def default_is_allowed_for_guest():
@@ -68,75 +293,845 @@ class NereidShipping(ModelSQL, ModelView):
         So it is better to pass the ID of the same and the get_rate
         method of each decide if they want to expand into CODE or NAME
 
+        The options could be pruned with the following arguments, see
+        :meth:`_get_pruned_methods`:
+
+            limit: Number of the cheapest options to return, at least 1
+            max_amount: Maximum amount of the options
+            first: Return only the first option available if set
+
+        """
+        destination = cls._get_destination(request.args)
+        destination['quote_context'] = cls.get_quote_context()
+
+        pruning = cls._get_pruning(request.args)
+        if pruning:
+            # A partial quote is not remembered, as the method selected
+            # later may not be in it
+            result = cls._get_pruned_methods(**dict(destination, **pruning))
+            return jsonify(
+                result=[(g.id, g.name, g.amount) for g in result]
+            )
+
+        result = cls._get_available_methods(**destination)
+
+        # Remember the quote, so that the rate of the method selected from
+        # it need not be computed again when the order is submitted
+        key = cls._get_quote_digest(**destination)
+        session['shipping_quote'] = [
+            cls.dump_quote_token(option, key) for option in result
+            if option.amount is not None
+        ]
+        return jsonify(
+            result=[(g.id, g.name, g.amount) for g in result]
+        )
+
+    @classmethod
+    def stream_available_methods(cls):
+        """Stream the shipment methods available as newline delimited JSON
+
+        This is a XHR only method, which takes the same arguments as
+        :meth:`get_available_methods`. Each option is written as a JSON
+        object with the `id`, `name` and `amount` on its own line as soon
+        as the method which computes it is done, so that fast methods need
+        not wait for slow ones. The stream ends with the line::
+
+            {"done": true}
+
+        Unlike get_available_methods, the quote is not remembered in the
+        session, as the session is saved before the stream is written.
+        """
+        destination = cls._get_destination(request.args)
+        destination['quote_context'] = cls.get_quote_context()
+
+        transaction = Transaction()
+        database_name = transaction.cursor.database_name
+        user, context = transaction.user, transaction.context.copy()
+
+        def generate():
+            if Transaction().cursor is not None:
+                # The transaction of the request is still open, as when the
+                # application does not handle the transactions
+                for line in cls._iter_stream_lines(**destination):
+                    yield line
+                return
+            with Transaction().start(
+                    database_name, user, readonly=True, context=context):
+                for line in cls._iter_stream_lines(**destination):
+                    yield line
+
+        return current_app.response_class(
+            stream_with_context(generate()),
+            mimetype='application/x-ndjson',
+            headers={'X-Accel-Buffering': 'no'},
+        )
+
+    @classmethod
+    def _iter_stream_lines(cls, **kwargs):
+        "Yield the lines of the stream of stream_available_methods"
+        for option in cls._iter_available_methods(**kwargs):
+            yield json.dumps(dict(
+                id=option.id, name=option.name, amount=option.amount
+            )) + '\n'
+        yield json.dumps({'done': True}) + '\n'
+
+    @classmethod
+    def get_available_methods_batch(cls):
+        """Return the JSONified lists of shipment methods available for
+        each of a list of destinations
+
+        This is a XHR only method, which expects a JSON body of the form::
+
+            {
+                "destinations": [
+                    {"address": <id of the address of the user>},
+                    {"country": <id>, "subdivision": <id>, "zip": <zip>},
+                    ...
+                ]
+            }
+
+        Each destination takes the same arguments as
+        :meth:`get_available_methods`, and optionally a `cart` snapshot
+        with the `total_amount`, `weight` (in kg) and `quantity` to quote
+        instead of the current cart. At most `SHIPPING_BATCH_LIMIT` (100 by
+        default) destinations are accepted.
+
+        The result is a list of the options of each destination, in order.
+        """
+        data = request.get_json(silent=True) or {}
+        values = data.get('destinations')
+        if not isinstance(values, list) or \
+                len(values) > current_app.config.get(
+                    'SHIPPING_BATCH_LIMIT', 100):
+            abort(400)
+
+        quote_context = cls.get_quote_context()
+        destinations = []
+        for value in values:
+            if not isinstance(value, dict):
+                abort(400)
+            destination = cls._get_destination(value)
+            destination['quote_context'] = quote_context
+            if 'cart' in value:
+                destination['quote_context'] = cls._get_snapshot_context(
+                    value['cart']
+                )
+            destinations.append(destination)
+
+        return jsonify(result=[
+            [(g.id, g.name, g.amount) for g in options]
+            for options in cls._get_available_methods_batch(destinations)
+        ])
+
+    @classmethod
+    def _get_destination(cls, values):
+        """Return the keyword arguments for _get_available_methods from
+        the arguments of a request, see :meth:`get_available_methods`
         """
         Address = Pool().get('party.address')
 
-        if 'address' in request.args:
+        if 'address' in values:
             if request.is_guest_user:
                 abort(403)
             # If not validated as user's address this could lead to
             # exploitation by ID
-            address_id = request.args.get('address', type=int)
+            try:
+                address_id = int(values['address'])
+            except (TypeError, ValueError):
+                abort(403)
             if address_id not in [
                 a.id for a in request.nereid_user.party.addresses
             ]:
                 abort(403)
-            address = Address(address_id)
-            result = cls._get_available_methods(
-                street=address.street,
-                streetbis=address.streetbis,
-                city=address.city,
-                zip=address.zip,
-                subdivision=address.subdivision.id,
-                country=address.country.id,
+            return cls._get_address_destination(Address(address_id))
+
+        # Each specified manually
+        try:
+            subdivision = values.get('subdivision')
+            return dict(
+                street=values.get('street'),
+                streetbis=values.get('streetbis'),
+                city=values.get('city'),
+                zip=values.get('zip'),
+                subdivision=int(subdivision) if subdivision else None,
+                country=int(values.get('country')),
             )
-        else:
-            # Each specified manually
-            result = cls._get_available_methods(
-                street=request.args.get('street'),
-                streetbis=request.args.get('streetbis'),
-                city=request.args.get('city'),
-                zip=request.args.get('zip'),
-                subdivision=int(request.args.get('subdivision')),
-                country=int(request.args.get('country')),
+        except (TypeError, ValueError):
+            abort(400)
+
+    @staticmethod
+    def _get_pruning(values):
+        """Return the keyword arguments for _get_pruned_methods from the
+        arguments of a request, see :meth:`get_available_methods`
+        """
+        pruning = {}
+        try:
+            if values.get('limit'):
+                pruning['limit'] = int(values['limit'])
+            if values.get('max_amount'):
+                pruning['max_amount'] = float(values['max_amount'])
+        except ValueError:
+            abort(400)
+        if pruning.get('limit', 1) < 1:
+            abort(400)
+        if values.get('first'):
+            pruning['first_available'] = True
+        return pruning
+
+    @classmethod
+    def _get_snapshot_context(cls, cart):
+        """Return the :class:`quote.QuoteContext` of a snapshot of a cart
+        sent by the client, see :meth:`get_available_methods_batch`
+        """
+        if not isinstance(cart, dict):
+            abort(400)
+        try:
+            return QuoteContext.from_snapshot(
+                request.nereid_website.id, request.is_guest_user,
+                Decimal(str(cart.get('total_amount', 0))),
+                float(cart.get('weight', 0)),
+                float(cart.get('quantity', 0)),
             )
-        return jsonify(
-            result=[(g['id'], g['name'], g['amount']) for g in result]
+        except (TypeError, ValueError, ArithmeticError):
+            abort(400)
+
+    @classmethod
+    def _get_available_methods_batch(cls, destinations):
+        """Return the list of options of each destination, where each
+        destination is the keyword arguments for _get_available_methods.
+
+        Identical destinations are quoted once, and the method models
+        which define a `prefetch_rates(destinations)` classmethod are given
+        the whole batch first, so that they can load what they need for
+        all the destinations in bulk.
+        """
+        for model in cls.get_method_models():
+            prefetch = getattr(Pool().get(model), 'prefetch_rates', None)
+            if prefetch is not None:
+                prefetch(destinations)
+
+        quotes = {}
+        results = []
+        for destination in destinations:
+            key = cls._get_quote_key(**destination)
+            if key not in quotes:
+                quotes[key] = cls._get_available_methods(**destination)
+            results.append(list(quotes[key]))
+        return results
+
+    @staticmethod
+    def _get_address_destination(address):
+        """Return the keyword arguments for _get_available_methods to ship
+        to the given party.address
+        """
+        return dict(
+            street=address.street,
+            streetbis=address.streetbis,
+            city=address.city,
+            zip=address.zip,
+            subdivision=address.subdivision and address.subdivision.id,
+            country=address.country.id,
         )
 
     @classmethod
     def _get_available_methods(cls, **kwargs):
-        """Return the list of tuple of available shipment methods
+        """Return the list of :class:`quote.RateOption` of the available
+        shipment methods
 
         The method calls the get_rate method of each available shipping
         method with the keyword arguments in kwargs and queue. The method can
         use whatever data it wants to use from the kwargs and add a shipping
         option to the queue (using queue.put). The API expects the option
-        to be a dictionary of the following format::
+        to be a :class:`quote.RateOption`, or a dictionary of the following
+        format::
 
             {
                 'id': <id of shipping method>,
                 'name': <name to display on website>,
                 'amount': <estimated amount>
             }
+
+        The name of the method model is set as the `model` of each option.
+
+        The cart is loaded once for all the methods and passed to them as
+        the `quote_context` keyword argument. See :meth:`get_quote_context`.
+
+        The options are cached for `SHIPPING_QUOTE_CACHE_TTL` seconds (300
+        by default, 0 disables the cache) under the key returned by
+        :meth:`_get_quote_key`, or until the configuration changes. The
+        cache is shared by the processes if a shared backend is configured,
+        see :class:`cache.SharedCache`. Quotes which miss the rates of a
+        method which timed out or failed are not cached.
+        """
+        kwargs.setdefault('quote_context', cls.get_quote_context())
+
+        ttl = current_app.config.get('SHIPPING_QUOTE_CACHE_TTL', 300)
+        if not ttl:
+            return cls._compute_available_methods(**kwargs)
+
+        key = cls._get_quote_key(**kwargs)
+        version = cls.get_config_version(key[0])
+        options = cls._quote_cache.get(key[0], version, key)
+        if options is None:
+            dropped = set()
+            options = cls._compute_available_methods(dropped=dropped, **kwargs)
+            if not dropped:
+                cls._quote_cache.set(key[0], version, key, tuple(options), ttl)
+        return list(options)
+
+    @classmethod
+    def _iter_available_methods(cls, **kwargs):
+        """Yield the options of :meth:`_get_available_methods` one by one,
+        as soon as the method which computes each is done rather than all
+        at once in the order of the methods. The options are cached like
+        the ones of _get_available_methods once every method is done, if
+        none of them timed out or failed.
+        """
+        kwargs.setdefault('quote_context', cls.get_quote_context())
+
+        ttl = current_app.config.get('SHIPPING_QUOTE_CACHE_TTL', 300)
+        if ttl:
+            key = cls._get_quote_key(**kwargs)
+            version = cls.get_config_version(key[0])
+            options = cls._quote_cache.get(key[0], version, key)
+            if options is not None:
+                for option in options:
+                    yield option
+                return
+
+        results, dropped = {}, set()
+        for index, options in cls._iter_method_rates(
+                cls.get_eligible_method_models(**kwargs), dropped=dropped,
+                **kwargs):
+            results[index] = options
+            for option in options:
+                yield option
+
+        if ttl and not dropped:
+            cls._quote_cache.set(key[0], version, key, tuple(
+                option for index in sorted(results)
+                for option in results[index]
+            ), ttl)
+
+    @classmethod
+    def _get_pruned_methods(
+            cls, limit=None, max_amount=None, first_available=False,
+            **kwargs):
+        """Return the options of :meth:`_get_available_methods` pruned to
+        the `limit` cheapest ones, the ones of at most `max_amount`, or the
+        first one available.
+
+        The options are taken from the quote cache if the whole quote is
+        cached. Otherwise the methods are run in the order of their cost
+        (see :meth:`get_rate_cost`), and the remaining methods are skipped
+        as soon as they cannot change the result: after the first option
+        if `first_available`, or once `limit` options are found which are
+        not dearer than the floor (see :meth:`get_rate_floor`) of any of
+        the remaining methods.
+        """
+        kwargs.setdefault('quote_context', cls.get_quote_context())
+
+        options = None
+        if current_app.config.get('SHIPPING_QUOTE_CACHE_TTL', 300):
+            key = cls._get_quote_key(**kwargs)
+            options = cls._quote_cache.get(
+                key[0], cls.get_config_version(key[0]), key
+            )
+        if options is None:
+            options = cls._dispatch_pruned(
+                limit, max_amount, first_available, **kwargs
+            )
+        options = [
+            option for option in options
+            if max_amount is None or option.amount <= max_amount
+        ]
+
+        if first_available:
+            return options[:1]
+        if limit:
+            # The sort is stable, so the order of the methods is kept
+            # between options of the same amount
+            return sorted(options, key=lambda o: o.amount)[:limit]
+        return options
+
+    @classmethod
+    def _dispatch_pruned(cls, limit, max_amount, first_available, **kwargs):
+        """Run the methods in the order of their cost until the result of
+        _get_pruned_methods is known and return the options found
+        """
+        method_models = sorted(
+            cls.get_eligible_method_models(**kwargs), key=cls.get_rate_cost
+        )
+        floors = map(cls.get_rate_floor, method_models)
+
+        options, pending = [], set(xrange(len(method_models)))
+        with closing(cls._iter_method_rates(
+                method_models, lazy=True, **kwargs)) as rates:
+            for index, method_options in rates:
+                pending.discard(index)
+                options.extend(
+                    option for option in method_options
+                    if max_amount is None or option.amount <= max_amount
+                )
+                if first_available and options:
+                    break
+                if limit and len(options) >= limit and all(
+                        sorted(o.amount for o in options)[limit - 1] <=
+                        floors[i] for i in pending):
+                    break
+        return options
+
+    @staticmethod
+    def get_rate_cost(model):
+        """Return the cost hint of computing the rates of the method model,
+        which is its `rate_cost` attribute. Methods which do not declare
+        one are assumed to be expensive, like remote carrier APIs.
+        """
+        return getattr(Pool().get(model), 'rate_cost', 100)
+
+    @staticmethod
+    def get_rate_floor(model):
+        """Return the lowest amount the method model could quote, which is
+        its `rate_floor` attribute or 0.
+        """
+        return getattr(Pool().get(model), 'rate_floor', 0)
+
+    @staticmethod
+    def get_rate_timeout(model):
+        """Return the seconds the requests of the carrier method model may
+        take, which is its `rate_timeout` attribute or
+        `SHIPPING_CARRIER_TIMEOUT` in the application config (5 by
+        default).
+        """
+        return getattr(Pool().get(model), 'rate_timeout', None) or \
+            current_app.config.get('SHIPPING_CARRIER_TIMEOUT', 5)
+
+    @classmethod
+    def _get_quote_key(cls, **kwargs):
+        """Return the key under which the options for a destination are
+        cached. It is made of the website, the guest flag, the country,
+        subdivision and zip of the destination, a fingerprint of the
+        cart, so that any change to the cart is a different quote, and the
+        values of the context which change the options (see
+        :meth:`_get_quote_context_key`).
+        """
+        quote_context = kwargs.get('quote_context') or \
+            cls.get_quote_context()
+        return (
+            quote_context.website, quote_context.guest,
+            kwargs.get('country'), kwargs.get('subdivision'),
+            kwargs.get('zip'), quote_context.fingerprint,
+            cls._get_quote_context_key(),
+        )
+
+    @classmethod
+    def _get_quote_context_key(cls):
+        """Return the values of the context which change the options of a
+        quote: the language of the names of the methods, and the currency
+        and price list of their amounts.
+        """
+        context = Transaction().context
+        currency = context.get('currency')
+        if currency is None and has_request_context():
+            currency = request.nereid_currency.id
+        return (
+            Transaction().language, currency, context.get('price_list'),
+        )
+
+    @classmethod
+    def get_quote_context(cls):
+        """Return the :class:`quote.QuoteContext` of the cart of the
+        current request.
+        """
+        Cart = Pool().get('nereid.cart')
+
+        return QuoteContext.from_sale(
+            request.nereid_website.id, request.is_guest_user,
+            Cart.open_cart().sale
+        )
+
+    @classmethod
+    def _get_quote_digest(cls, **kwargs):
+        """Return a digest of the quote key and the version of the
+        configuration of the website, which could be kept in the session
+        to check if a quote is still valid.
+        """
+        key = cls._get_quote_key(**kwargs)
+        return sha1(
+            repr((key, cls.get_config_version(key[0])))
+        ).hexdigest()
+
+    @staticmethod
+    def get_quote_serializer():
+        """Return the serializer which signs the quote tokens with the
+        secret key of the application
+        """
+        return URLSafeTimedSerializer(
+            current_app.secret_key, salt='nereid.shipping.quote'
+        )
+
+    @classmethod
+    def dump_quote_token(cls, option, key):
+        """Return a signed token of the quoted option, which records the
+        method, its name and amount and the digest of the quote (see
+        :meth:`_get_quote_digest`), which covers the destination, the cart
+        and the configuration.
+
+        :param option: The :class:`quote.RateOption`
+        :param key: Digest of the quote
+        """
+        return cls.get_quote_serializer().dumps([
+            option.model, option.id, option.name, str(option.amount), key
+        ])
+
+    @classmethod
+    def load_quote_token(cls, token):
+        """Return a tuple of the :class:`quote.RateOption` and the digest
+        of the quote of a token, or None if the token was tampered with,
+        cannot be decoded or is older than `SHIPPING_QUOTE_TOKEN_TTL`
+        seconds in the application config (an hour by default).
+        """
+        try:
+            model, id_, name, amount, key = cls.get_quote_serializer().loads(
+                token, max_age=current_app.config.get(
+                    'SHIPPING_QUOTE_TOKEN_TTL', 3600
+                )
+            )
+            return RateOption(id_, name, Decimal(amount), model), key
+        except (BadSignature, TypeError, ValueError, ArithmeticError):
+            return None
+
+    @classmethod
+    def get_eligible_method_models(cls, **kwargs):
+        """Return the names of the method models to dispatch for the
+        keyword arguments of _get_available_methods: those which have a
+        record allowed on the website that ships to the destination
+        country, according to the rate plan of the website, and the
+        models which are not a :class:`ShippingConfigMixin`, whose changes
+        the plan does not follow.
+        """
+        Website = Pool().get('nereid.website')
+
+        quote_context = kwargs.get('quote_context') or \
+            cls.get_quote_context()
+        eligible = cls.get_rate_plan(Website(quote_context.website)).models(
+            kwargs.get('country'), quote_context.guest
+        )
+        return [
+            model for model in cls.get_method_models()
+            if model in eligible or
+            not issubclass(Pool().get(model), ShippingConfigMixin)
+        ]
+
+    @classmethod
+    def _compute_available_methods(cls, dropped=None, **kwargs):
+        """Return the list of options of the eligible shipping methods,
+        computed by calling their get_rate methods.
+
+        :param dropped: Set to which the indexes of the methods whose rates
+                        are missing or incomplete are added, see
+                        :meth:`_iter_method_rates`
         """
-        Model = Pool().get('ir.model')
-        shipping_method_models = Model.search(
-            [('model', 'ilike', 'nereid.shipping.%')]
+        method_models = cls.get_eligible_method_models(**kwargs)
+
+        results = dict(cls._iter_method_rates(
+            method_models, dropped=dropped, **kwargs
+        ))
+        return [
+            option for index in sorted(results) for option in results[index]
+        ]
+
+    @classmethod
+    def _iter_method_rates(
+            cls, method_models, dropped=None, lazy=False, **kwargs):
+        """Yield a tuple of (index, options) for each method model as its
+        rates become available. The index is the position of the model in
+        method_models.
+
+        If `SHIPPING_RATE_WORKERS` is set to more than one in the
+        application config, the methods are run concurrently in a bounded
+        pool of threads, each with its own transaction. The following
+        options are then honoured:
+
+        `SHIPPING_RATE_TIMEOUT`
+            Seconds a single method may take before its rates are dropped.
+
+        `SHIPPING_RATE_DEADLINE`
+            Seconds after which the rates of all pending methods are
+            dropped. Defaults to 10.
+
+        Otherwise the methods are run one after the other in the current
+        transaction.
+
+        The requests of the carrier methods (those with a
+        get_rate_requests method, see :class:`carrier.CarrierRateMixin`)
+        are all sent first, and their responses parsed once the other
+        methods are done. If `lazy`, as when the caller may stop early, the
+        methods are run in their order instead, and the requests of each
+        carrier method are only sent once the methods before it are done.
+
+        If a set is given as `dropped`, the indexes of the methods whose
+        rates are missing or incomplete are added to it: those which timed
+        out or failed in a worker, and the carrier methods which failed or
+        had a failed request (see :attr:`carrier.RateResponse.failed`).
+        """
+        if dropped is None:
+            dropped = set()
+
+        carriers = set(
+            index for index, model in enumerate(method_models)
+            if hasattr(Pool().get(model), 'get_rate_requests')
         )
 
-        # Initialise a Queue and add it to kwargs, this is designed
-        # this way so that in future this could be run simultaneously
-        # in separate transactions in a multithreaded simultaneous
-        # fashion. This may greatly speed up processes
-        queue = Queue()
-        kwargs['queue'] = queue
+        if lazy:
+            others = []
+            for index, model in enumerate(method_models):
+                if index not in carriers:
+                    others.append((index, model))
+                    continue
+                for rates in cls._iter_local_rates(others, dropped, **kwargs):
+                    yield rates
+                others = []
+                fetch = cls._start_carrier_fetch(model, **kwargs)
+                yield index, cls._get_carrier_rates(
+                    index, model, fetch, dropped, **kwargs
+                )
+            for rates in cls._iter_local_rates(others, dropped, **kwargs):
+                yield rates
+            return
 
-        for model in shipping_method_models:
-            Method = Pool().get(model.model)
+        fetches = dict(
+            (index, cls._start_carrier_fetch(method_models[index], **kwargs))
+            for index in carriers
+        )
+        for rates in cls._iter_local_rates([
+                (index, model) for index, model in enumerate(method_models)
+                if index not in carriers], dropped, **kwargs):
+            yield rates
+        for index in sorted(fetches):
+            yield index, cls._get_carrier_rates(
+                index, method_models[index], fetches[index], dropped,
+                **kwargs
+            )
+
+    @classmethod
+    def _iter_local_rates(cls, methods, dropped, **kwargs):
+        """Yield the (index, options) of the methods, a list of tuples of
+        the index and the model of the methods which are not carrier
+        methods, in a pool of workers if `SHIPPING_RATE_WORKERS` allows
+        it. See :meth:`_iter_method_rates`.
+        """
+        workers = current_app.config.get('SHIPPING_RATE_WORKERS') or 1
+        if workers > 1 and len(methods) > 1:
+            positions = set()
+            for position, options in cls._iter_method_rates_concurrently(
+                    [model for index, model in methods],
+                    min(workers, len(methods)), dropped=positions, **kwargs):
+                yield methods[position][0], options
+            dropped.update(methods[position][0] for position in positions)
+        else:
+            for index, model in methods:
+                yield index, cls._get_method_rates(model, **kwargs)
+
+    @classmethod
+    def _start_carrier_fetch(cls, model, **kwargs):
+        """Send the requests of the carrier method model and return the
+        :class:`carrier.CarrierFetch` of their responses, or None if the
+        method failed to describe its requests. The call of
+        get_rate_requests is recorded in :data:`stats.rate_stats` under
+        the name of the model followed by `/requests`.
+        """
+        Method = Pool().get(model)
+        try:
+            with cls._measure_rates(
+                    '%s/requests' % model, RateCollector(model)):
+                rate_requests = Method.get_rate_requests(**kwargs)
+        except Exception:
+            current_app.logger.exception(
+                "Shipping method %s failed" % model
+            )
+            return None
+        return CarrierFetch(rate_requests, cls.get_rate_timeout(model))
+
+    @classmethod
+    def _get_carrier_rates(cls, index, model, fetch, dropped, **kwargs):
+        """Wait for the responses of the fetch of the carrier method model
+        and return the options parsed from them. A method which failed, or
+        which had a failed request, has its index added to `dropped`.
+        """
+        if fetch is None:
+            dropped.add(index)
+            return []
+        responses = fetch.wait()
+        if any(response.failed for response in responses):
+            dropped.add(index)
+        try:
+            return cls._get_method_rates(
+                model, rate_responses=responses, **kwargs
+            )
+        except Exception:
+            current_app.logger.exception(
+                "Shipping method %s failed" % model
+            )
+            dropped.add(index)
+            return []
+
+    @classmethod
+    def _get_method_rates(cls, model, **kwargs):
+        """Call the get_rate method of the given method model and return
+        the list of :class:`quote.RateOption` it put on the queue.
+
+        The wall time, the number of queries and options and the errors of
+        each call are recorded in :data:`stats.rate_stats` and logged,
+        unless `SHIPPING_RATE_STATS` is set to False in the application
+        config.
+        """
+        # The collector is used by the method as a queue. Each call has its
+        # own, so even when the methods are run simultaneously in separate
+        # threads, it need not lock
+        collector = RateCollector(model)
+        kwargs['queue'] = collector
+
+        Method = Pool().get(model)
+        with cls._measure_rates(model, collector):
             getattr(Method, 'get_rate')(**kwargs)
 
-        return [record for record in queue.queue]
+        return collector.options
+
+    @staticmethod
+    @contextmanager
+    def _measure_rates(name, collector):
+        """Record the rate computation in the block under the name in
+        :data:`stats.rate_stats`, unless `SHIPPING_RATE_STATS` is False in
+        the application config
+        """
+        if current_app.config.get('SHIPPING_RATE_STATS', True):
+            with rate_stats.measure(name, Transaction().cursor, collector):
+                yield
+        else:
+            yield
+
+    @staticmethod
+    def get_rate_stats():
+        """Return the stats of the rate computation of each method model in
+        this process, see :class:`stats.RateStats`
+        """
+        return rate_stats.snapshot()
+
+    @classmethod
+    def _iter_method_rates_concurrently(
+            cls, method_models, workers, dropped=None, **kwargs):
+        """Run the get_rate of the method models in a pool of worker
+        threads and yield the (index, options) of each method as it
+        completes. Methods which exceed the timeout or the deadline are
+        logged and skipped, and methods which fail have no options. The
+        indexes of both are added to the `dropped` set if one is given.
+        """
+        if dropped is None:
+            dropped = set()
+
+        config = current_app.config
+        method_timeout = config.get('SHIPPING_RATE_TIMEOUT')
+        deadline = time.time() + config.get('SHIPPING_RATE_DEADLINE', 10)
+
+        # Evaluate the lazy attributes of the request here, as the request
+        # object is shared with the workers
+        request.nereid_website, request.is_guest_user
+
+        jobs, events, cancelled = Queue(), Queue(), threading.Event()
+        for job in enumerate(method_models):
+            jobs.put(job)
+
+        transaction = Transaction()
+        for i in xrange(workers):
+            worker = threading.Thread(
+                target=cls._rate_worker,
+                args=(
+                    jobs, events, cancelled, _app_ctx_stack.top,
+                    _request_ctx_stack.top, transaction.cursor.database_name,
+                    transaction.user, transaction.context.copy(), kwargs,
+                ),
+            )
+            worker.daemon = True
+            worker.start()
+
+        pending, started = set(xrange(len(method_models))), {}
+        try:
+            while pending:
+                now = time.time()
+                expiries = dict(
+                    (index, started[index] + method_timeout)
+                    for index in pending
+                    if method_timeout is not None and index in started
+                )
+                for index in [i for i in expiries if expiries[i] <= now]:
+                    current_app.logger.warning(
+                        "Shipping method %s timed out" % method_models[index]
+                    )
+                    rate_stats.record_timeout(method_models[index])
+                    del expiries[index]
+                    pending.discard(index)
+                    dropped.add(index)
+                if not pending:
+                    break
+                if now >= deadline:
+                    current_app.logger.warning(
+                        "Shipping rate deadline exceeded, skipping %s" %
+                        ', '.join(method_models[i] for i in sorted(pending))
+                    )
+                    for index in pending:
+                        rate_stats.record_timeout(method_models[index])
+                    dropped.update(pending)
+                    break
+                try:
+                    event, index, value = events.get(timeout=max(
+                        0, min([deadline] + expiries.values()) - now
+                    ))
+                except Empty:
+                    continue
+                if event == 'start':
+                    started[index] = value
+                elif index in pending:
+                    pending.discard(index)
+                    if value is None:
+                        dropped.add(index)
+                        value = []
+                    yield index, value
+        finally:
+            cancelled.set()
+
+    @classmethod
+    def _rate_worker(
+            cls, jobs, events, cancelled, app_context, request_context,
+            database_name, user, context, kwargs):
+        """Target of the worker threads started by
+        _iter_method_rates_concurrently. Picks method models from jobs until
+        there are none left or the dispatch is cancelled. The options of a
+        method which fails are reported as None.
+        """
+        _app_ctx_stack.push(app_context)
+        _request_ctx_stack.push(request_context)
+        try:
+            while not cancelled.is_set():
+                try:
+                    index, model = jobs.get_nowait()
+                except Empty:
+                    break
+                events.put(('start', index, time.time()))
+                options = None
+                try:
+                    with Transaction().start(
+                            database_name, user, readonly=True,
+                            context=context):
+                        options = cls._get_method_rates(model, **kwargs)
+                except Exception:
+                    current_app.logger.exception(
+                        "Shipping method %s failed" % model
+                    )
+                events.put(('done', index, options))
+        finally:
+            _request_ctx_stack.pop()
+            _app_ctx_stack.pop()
 
     @classmethod
     def add_shipping_line(cls, sale, shipment_method_id):
@@ -147,47 +1142,77 @@ class NereidShipping(ModelSQL, ModelView):
         '''
         SaleLine = Pool().get('sale.line')
 
-        address = sale.shipment_address
-        available_methods = cls._get_available_methods(
-            street=address.street,
-            streetbis=address.streetbis,
-            city=address.city,
-            zip=address.zip,
-            subdivision=address.subdivision.id,
-            country=address.country.id,
+        method = cls._get_selected_method(
+            shipment_method_id,
+            **cls._get_address_destination(sale.shipment_address)
         )
-
-        for method in available_methods:
-            if method['id'] == shipment_method_id:
-                if not method['amount']:
-                    current_app.logger.debug(
-                        "Shipping amount is %s" % method['amount'])
-                    break
-                values = {
-                    'description': 'Shipping (%s)' % method['name'],
-                    'sale': sale.id,
-                    'unit_price': Decimal(str(method['amount'])),
-                    'quantity': 1,
-                    'is_shipping_line': True,
-                }
-                existing_shipping_lines = SaleLine.search([
-                    ('sale', '=', sale.id),
-                    ('is_shipping_line', '=', True)
-                ])
-                if existing_shipping_lines:
-                    SaleLine.write(existing_shipping_lines, values)
-                else:
-                    SaleLine.create([values])
-                break
-        else:
+        if method is None:
             current_app.logger.debug(
-                'Selected shipment method (%s) not in ' +
-                'shipping_quote (%s) in session' %
-                (shipment_method_id, session['shipping_quote'])
+                'Selected shipment method (%s) not available' %
+                shipment_method_id
             )
             abort(403)
+
+        if not method.amount:
+            current_app.logger.debug(
+                "Shipping amount is %s" % method.amount)
+            return True
+
+        values = {
+            'description': 'Shipping (%s)' % method.name,
+            'sale': sale.id,
+            'unit_price': Decimal(str(method.amount)),
+            'quantity': 1,
+            'is_shipping_line': True,
+        }
+        existing_shipping_lines = [
+            line for line in sale.lines if line.is_shipping_line
+        ]
+        if existing_shipping_lines:
+            SaleLine.write(existing_shipping_lines, values)
+        else:
+            SaleLine.create([values])
         return True
 
+    @classmethod
+    def _get_selected_method(cls, shipment_method_id, **kwargs):
+        """Return the option of the selected shipment method for the
+        destination in kwargs, or None if the method is not available.
+
+        The quote returned to this session is kept as signed tokens (see
+        :meth:`dump_quote_token`). If the token of the selected option is
+        still valid for the destination and the cart, the option is taken
+        from it. If the destination, the cart or the configuration changed,
+        only the method model of the selected option is asked for a rate
+        again. Without a valid token of the selected option, like when it
+        was quoted by a stream, a batch or a pruned quote, the options of
+        every method are computed.
+        """
+        kwargs.setdefault('quote_context', cls.get_quote_context())
+
+        digest, method_models = None, []
+        for token in session.get('shipping_quote') or []:
+            quote = cls.load_quote_token(token)
+            if quote is None or quote[0].id != shipment_method_id:
+                continue
+            option, key = quote
+            if digest is None:
+                digest = cls._get_quote_digest(**kwargs)
+            if constant_time_compare(str(key), digest):
+                return option
+            if option.model not in method_models:
+                method_models.append(option.model)
+
+        if method_models:
+            options = []
+            for model in method_models:
+                options.extend(cls._get_method_rates(model, **kwargs))
+        else:
+            options = cls._get_available_methods(**kwargs)
+        for option in options:
+            if option.id == shipment_method_id:
+                return option
+
     @classmethod
     def get_rate(cls, **kwargs):
         """Default method, this should be overwritten by each
@@ -212,18 +1237,144 @@ class DefaultCheckout(ModelSQL):
         return Shipping.add_shipping_line(sale, form.shipment_method.data)
 
 
-class AvailableCountries(ModelSQL, ModelView):
+class AvailableCountries(ShippingConfigMixin, ModelSQL, ModelView):
     "Nereid Available Countries"
     __name__ = 'nereid.shipping-country.country'
 
     country = fields.Many2One(
         'country.country', 'Country',
-        ondelete='CASCADE', required=True
+        ondelete='CASCADE', required=True, select=True
     )
     shipping = fields.Many2One(
         'nereid.shipping', 'Shipping',
-        ondelete='CASCADE', required=True
+        ondelete='CASCADE', required=True, select=True
+    )
+
+
+class ShippingEligibility(ModelSQL):
+    """
+    Nereid Shipping Eligibility
+
+    The method records which ship to each country from each website,
+    denormalised from the active shippings, their countries and the
+    method records. The rows of a website are rebuilt whenever its
+    shipping configuration changes, and rate plans are compiled from them
+    with a single indexed query.
+    """
+    __name__ = 'nereid.shipping.eligibility'
+
+    website = fields.Many2One(
+        'nereid.website', 'Website', required=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    country = fields.Many2One(
+        'country.country', 'Country', required=True, readonly=True,
+        ondelete='CASCADE', select=True
     )
+    guest_allowed = fields.Boolean('Guest Allowed', readonly=True)
+    method_model = fields.Char('Method Model', required=True, readonly=True)
+    method_id = fields.Integer('Method ID', required=True, readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        Website = Pool().get('nereid.website')
+        cursor = Transaction().cursor
+
+        migrate = not TableHandler.table_exist(cursor, cls._table)
+
+        super(ShippingEligibility, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['website', 'country', 'guest_allowed'], 'add')
+
+        # Build the eligibility of the websites configured before the
+        # module kept it
+        if migrate:
+            cls.rebuild(map(int, Website.search([])))
+            # The modules registered after this one could provide more
+            # method models
+            Pool().get('nereid.shipping')._method_models_cache.clear()
+
+    @classmethod
+    def rebuild(cls, websites):
+        """Replace the eligibility of the websites with the one of their
+        current configuration. The rows are written directly in the
+        database, as the user changing the configuration may not be
+        allowed to write them.
+
+        :param websites: IDs of the websites
+        """
+        Shipping = Pool().get('nereid.shipping')
+        WebsiteShipping = Pool().get('nereid.website-nereid.shipping')
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        cursor.execute(*table.delete(where=table.website.in_(websites)))
+
+        # The shippings of a website with allowed shipping methods are
+        # restricted to those
+        allowed = defaultdict(set)
+        for row in WebsiteShipping.search_read(
+                [('website', 'in', websites)],
+                fields_names=['website', 'shipping']):
+            allowed[row['website']].add(row['shipping'])
+
+        shippings = {}
+        for shipping in Shipping.search_read(
+                [('website', 'in', websites)], fields_names=[
+                    'website', 'is_allowed_for_guest', 'available_countries',
+                ]):
+            if not allowed[shipping['website']] or \
+                    shipping['id'] in allowed[shipping['website']]:
+                shippings[shipping['id']] = shipping
+        rows = []
+        for model in Shipping.get_method_models():
+            # Only the models which rebuild the eligibility when they
+            # change are kept in it, the others are always dispatched
+            Method = Pool().get(model)
+            if not issubclass(Method, ShippingConfigMixin):
+                continue
+            for record in Method.search_read(
+                    [('shipping', 'in', shippings.keys())],
+                    fields_names=['shipping']):
+                shipping = shippings[record['shipping']]
+                for country in shipping['available_countries']:
+                    rows.append([
+                        shipping['website'], country,
+                        shipping['is_allowed_for_guest'], model,
+                        record['id'],
+                    ])
+
+        columns = [
+            table.website, table.country, table.guest_allowed,
+            table.method_model, table.method_id,
+        ]
+        # Keep the parameters of each statement within the database limits
+        size = cursor.IN_MAX // len(columns)
+        for index in xrange(0, len(rows), size):
+            cursor.execute(*table.insert(
+                columns=columns, values=rows[index:index + size]
+            ))
+
+
+class Sale(ModelSQL, ModelView):
+    "Sale"
+    __name__ = 'sale.sale'
+
+    #: The total weight (in kilograms) and quantity of the products in the
+    #: sale, kept up to date by the sale lines as they are added, changed
+    #: or removed.
+    shipping_weight = fields.Float('Shipping Weight', readonly=True)
+    shipping_quantity = fields.Float('Shipping Quantity', readonly=True)
+
+    @staticmethod
+    def default_shipping_weight():
+        return 0.0
+
+    @staticmethod
+    def default_shipping_quantity():
+        return 0.0
 
 
 class SaleLine(ModelSQL, ModelView):
@@ -234,6 +1385,188 @@ class SaleLine(ModelSQL, ModelView):
     #: of a shipping line
     is_shipping_line = fields.Boolean('Is Shipping Line?', readonly=True)
 
+    #: The weight (in kilograms) and quantity (in the default unit of the
+    #: product) of the line, which are added to the totals of the sale
+    shipping_weight = fields.Float('Shipping Weight', readonly=True)
+    shipping_quantity = fields.Float('Shipping Quantity', readonly=True)
+
+    _unit_weight_cache = Cache('sale.line.unit_weight', context=False)
+
+    #: Decimal places to which the weights and quantities of the lines and
+    #: the totals of the sales are rounded, so that adding and removing
+    #: lines does not drift the totals
+    _shipping_totals_digits = 6
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        table = TableHandler(cursor, cls, module_name)
+        migrate_totals = not table.column_exist('shipping_weight')
+
+        super(SaleLine, cls).__register__(module_name)
+
+        # Compute the totals of the carts which existed before the module
+        # kept them
+        if migrate_totals:
+            cls.update_shipping_totals(
+                cls.search([('sale.state', '=', 'draft')])
+            )
+
+    @classmethod
+    def create(cls, vlist):
+        lines = super(SaleLine, cls).create(vlist)
+        cls.update_shipping_totals(lines)
+        return lines
+
+    @classmethod
+    def write(cls, lines, values, *args):
+        fields_names = set(['sale', 'type', 'product', 'quantity', 'unit'])
+        actions = iter((lines, values) + args)
+        changed_lines = []
+        for records, values_ in zip(actions, actions):
+            if fields_names & set(values_):
+                changed_lines.extend(records)
+
+        super(SaleLine, cls).write(lines, values, *args)
+        if changed_lines:
+            cls.update_shipping_totals(cls.browse(changed_lines))
+
+    @classmethod
+    def delete(cls, lines):
+        totals = cls._read_shipping_totals(lines)
+        super(SaleLine, cls).delete(lines)
+        cls._add_to_sale_totals(totals, {})
+
+    @classmethod
+    def get_unit_weight(cls, product):
+        """Return the weight, in kilograms, of one default unit of the
+        product. The weight is cached until a product template is written.
+        """
+        Uom = Pool().get('product.uom')
+        ModelData = Pool().get('ir.model.data')
+
+        weight = cls._unit_weight_cache.get(product.id)
+        if weight is None:
+            template = product.template
+            weight = 0.0
+            if template.weight and template.weight_uom:
+                weight = Uom.compute_qty(
+                    template.weight_uom, template.weight,
+                    Uom(ModelData.get_id('product', 'uom_kilogram')),
+                    round=False
+                )
+            cls._unit_weight_cache.set(product.id, weight)
+        return weight
+
+    def get_shipping_totals(self):
+        """Return a tuple of the weight in kilograms and the quantity in
+        the default unit of the product of the line.
+        """
+        Uom = Pool().get('product.uom')
+
+        if self.type != 'line' or not self.product or self.is_shipping_line:
+            return 0.0, 0.0
+        quantity = Uom.compute_qty(
+            self.unit, self.quantity or 0.0,
+            self.product.default_uom, round=False
+        )
+        digits = self._shipping_totals_digits
+        return (
+            round(quantity * self.get_unit_weight(self.product), digits),
+            round(quantity, digits),
+        )
+
+    @classmethod
+    def update_shipping_totals(cls, lines):
+        """Compute the weight and quantity of the lines again, and add the
+        difference with the stored values to the totals of their sales.
+        """
+        sale_line = cls.__table__()
+        cursor = Transaction().cursor
+
+        old_totals = cls._read_shipping_totals(lines)
+        new_totals = {}
+        for line in lines:
+            weight, quantity = line.get_shipping_totals()
+            new_totals[line.id] = (line.sale.id, weight, quantity)
+            if old_totals[line.id][1:] != (weight, quantity):
+                cursor.execute(*sale_line.update(
+                    columns=[
+                        sale_line.shipping_weight, sale_line.shipping_quantity
+                    ],
+                    values=[weight, quantity],
+                    where=sale_line.id == line.id
+                ))
+        clear_record_cache(cls, new_totals.keys())
+        cls._add_to_sale_totals(old_totals, new_totals)
+
+    @classmethod
+    def _read_shipping_totals(cls, lines):
+        """Return a dictionary of the sale, weight and quantity stored on
+        each line by its ID.
+        """
+        return dict(
+            (
+                line['id'], (
+                    line['sale'], line['shipping_weight'] or 0.0,
+                    line['shipping_quantity'] or 0.0,
+                )
+            ) for line in cls.read(
+                map(int, lines),
+                ['sale', 'shipping_weight', 'shipping_quantity']
+            )
+        )
+
+    @classmethod
+    def _add_to_sale_totals(cls, old_totals, new_totals):
+        """Add the difference between the new and old totals of lines to
+        the totals of their sales. The totals are rounded as they are
+        updated, see :attr:`_shipping_totals_digits`.
+        """
+        Sale = Pool().get('sale.sale')
+        sale = Sale.__table__()
+        cursor = Transaction().cursor
+        digits = cls._shipping_totals_digits
+
+        differences = defaultdict(lambda: [0.0, 0.0])
+        for totals, sign in ((old_totals, -1), (new_totals, 1)):
+            for sale_id, weight, quantity in totals.itervalues():
+                differences[sale_id][0] += sign * weight
+                differences[sale_id][1] += sign * quantity
+
+        for sale_id, (weight, quantity) in differences.iteritems():
+            weight, quantity = round(weight, digits), round(quantity, digits)
+            if sale_id is None or (weight, quantity) == (0.0, 0.0):
+                continue
+            cursor.execute(*sale.update(
+                columns=[sale.shipping_weight, sale.shipping_quantity],
+                values=[
+                    Round(Cast(
+                        Coalesce(sale.shipping_weight, 0) + weight, 'NUMERIC'
+                    ), digits),
+                    Round(Cast(
+                        Coalesce(sale.shipping_quantity, 0) + quantity,
+                        'NUMERIC'
+                    ), digits),
+                ],
+                where=sale.id == sale_id
+            ))
+        clear_record_cache(Sale, differences.keys())
+
+
+class Template(ModelSQL, ModelView):
+    "Product Template"
+    __name__ = 'product.template'
+
+    @classmethod
+    def write(cls, templates, values, *args):
+        SaleLine = Pool().get('sale.line')
+
+        super(Template, cls).write(templates, values, *args)
+        SaleLine._unit_weight_cache.clear()
+
 
 class Website(ModelSQL, ModelView):
     "Website"
@@ -241,19 +1574,94 @@ class Website(ModelSQL, ModelView):
 
     allowed_ship_methods = fields.Many2Many(
         'nereid.website-nereid.shipping',
-        'website', 'shipping', 'Allowed Shipping Methods'
+        'website', 'shipping', 'Allowed Shipping Methods',
+        help="The shipping methods of the website which are offered. All "
+        "of them are offered if none is selected."
+    )
+    shipping_estimates_stale = fields.Boolean(
+        'Shipping Estimates Stale', readonly=True,
+        help="The shipping configuration changed since the shipping "
+        "estimates were computed"
     )
+    shipping_config_version = fields.Integer(
+        'Shipping Configuration Version', readonly=True,
+        help="Incremented whenever the shipping configuration changes"
+    )
+    shipping_config_stamp = fields.Char(
+        'Shipping Configuration Stamp', readonly=True,
+        help="Random value written with each version of the shipping "
+        "configuration, so that a version rolled back, restored or "
+        "recreated is never mistaken for another"
+    )
+
+    @classmethod
+    def __register__(cls, module_name):
+        website = cls.__table__()
+        cursor = Transaction().cursor
+
+        super(Website, cls).__register__(module_name)
+
+        # Stamp the websites created before the stamp was kept
+        cursor.execute(*website.select(
+            website.id, where=website.shipping_config_stamp == Null
+        ))
+        for website_id, in cursor.fetchall():
+            cursor.execute(*website.update(
+                columns=[website.shipping_config_stamp],
+                values=[uuid4().hex], where=website.id == website_id
+            ))
+
+    @staticmethod
+    def default_shipping_estimates_stale():
+        return True
+
+    @staticmethod
+    def default_shipping_config_version():
+        return 0
 
+    @staticmethod
+    def default_shipping_config_stamp():
+        return uuid4().hex
 
-class WebsiteShipping(ModelSQL, ModelView):
+    @classmethod
+    def bump_shipping_config_version(cls, ids):
+        """Increment the version of the shipping configuration of the
+        websites with a new stamp and mark their shipping estimates as
+        stale. The columns are updated directly in the database, as the
+        user changing the shipping configuration may not be allowed to
+        write websites.
+        """
+        website = cls.__table__()
+        cursor = Transaction().cursor
+
+        cursor.execute(*website.update(
+            columns=[
+                website.shipping_config_version,
+                website.shipping_config_stamp,
+                website.shipping_estimates_stale,
+            ],
+            values=[
+                Coalesce(website.shipping_config_version, 0) + 1,
+                uuid4().hex, True,
+            ],
+            where=website.id.in_(ids)
+        ))
+        clear_record_cache(cls, ids)
+
+
+class WebsiteShipping(ShippingConfigMixin, ModelSQL, ModelView):
     "Website Shipping Rel"
     __name__ = 'nereid.website-nereid.shipping'
 
     website = fields.Many2One(
         'nereid.website', 'website',
-        ondelete='CASCADE', required=True
+        ondelete='CASCADE', required=True, select=True
     )
     shipping = fields.Many2One(
         'nereid.shipping', 'shipping',
-        ondelete='CASCADE', required=True
+        ondelete='CASCADE', required=True, select=True
     )
+
+    @classmethod
+    def get_config_websites(cls, records):
+        return set(record.website.id for record in records)
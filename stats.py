@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+    stats
+
+    Instrumentation of the rate computation of the shipping methods
+
+    :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) LTD
+    :license: GPLv3, see LICENSE for more details.
+"""
+import time
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+__all__ = ['Histogram', 'MethodStats', 'RateStats', 'count_queries']
+
+#: Structured records of each rate computation are logged at INFO level to
+#: this logger, with the measurements in the `shipping_rate` attribute
+logger = logging.getLogger('nereid.shipping.rates')
+
+
+@contextmanager
+def count_queries(cursor):
+    """Count the queries executed on the trytond cursor in the block. A
+    list whose only item is the count is returned as the context.
+    """
+    counter = [0]
+    previous = cursor.__dict__.get('execute')
+    execute = cursor.execute
+
+    def counting_execute(*args, **kwargs):
+        counter[0] += 1
+        return execute(*args, **kwargs)
+
+    cursor.execute = counting_execute
+    try:
+        yield counter
+    finally:
+        if previous is None:
+            del cursor.execute
+        else:
+            cursor.execute = previous
+
+
+class Histogram(object):
+    """
+    The number of observations in each of a fixed set of buckets, along
+    with their count and sum.
+
+    :param buckets: Sorted upper bounds (inclusive) of the buckets. Values
+                    above the last bound are counted in an extra bucket.
+    """
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self):
+        "Return the histogram with cumulative counts by upper bound"
+        cumulative, buckets = 0, []
+        for bound, count in zip(self.buckets + ('+Inf', ), self.counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {'buckets': buckets, 'count': self.count, 'sum': self.sum}
+
+
+class MethodStats(object):
+    """
+    The counters and histograms of the rate computations of a method model
+    """
+    __slots__ = ('calls', 'errors', 'timeouts', 'options', 'time', 'queries')
+
+    def __init__(self, time_buckets, query_buckets):
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.options = 0
+        self.time = Histogram(time_buckets)
+        self.queries = Histogram(query_buckets)
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'options': self.options,
+            'time': self.time.as_dict(),
+            'queries': self.queries.as_dict(),
+        }
+
+
+class RateStats(object):
+    """
+    The stats of the rate computations of every method model in this
+    process. It is updated from the worker threads of the concurrent rate
+    computation too, so the updates are serialised with a lock.
+
+    :param time_buckets: Upper bounds of the buckets of the wall time in
+                         seconds
+    :param query_buckets: Upper bounds of the buckets of the number of SQL
+                          queries
+    """
+
+    def __init__(
+            self, time_buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1,
+                                2.5, 5, 10),
+            query_buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250)):
+        self.time_buckets = time_buckets
+        self.query_buckets = query_buckets
+        self._lock = threading.Lock()
+        self._methods = {}
+
+    def _get_method(self, model):
+        stats = self._methods.get(model)
+        if stats is None:
+            stats = self._methods[model] = MethodStats(
+                self.time_buckets, self.query_buckets
+            )
+        return stats
+
+    def record(self, model, duration, queries, options, error=False):
+        """Record a rate computation of the method model
+
+        :param duration: Wall time in seconds
+        :param queries: Number of SQL queries
+        :param options: Number of options emitted
+        :param error: True if the computation raised an exception
+        """
+        with self._lock:
+            stats = self._get_method(model)
+            stats.calls += 1
+            stats.errors += bool(error)
+            stats.options += options
+            stats.time.observe(duration)
+            stats.queries.observe(queries)
+
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "Shipping rate of %s in %.3fs, %d queries, %d options%s",
+                model, duration, queries, options, error and ', failed' or '',
+                extra={'shipping_rate': {
+                    'model': model,
+                    'duration': duration,
+                    'queries': queries,
+                    'options': options,
+                    'error': error,
+                }}
+            )
+
+    def record_timeout(self, model):
+        "Record that the rates of the method model were dropped"
+        with self._lock:
+            self._get_method(model).timeouts += 1
+
+    @contextmanager
+    def measure(self, model, cursor, queue):
+        """Record the rate computation of the method model in the block,
+        which puts its options on the queue and runs its queries on the
+        cursor
+        """
+        start, error = time.time(), False
+        with count_queries(cursor) as queries:
+            try:
+                yield
+            except Exception:
+                error = True
+                raise
+            finally:
+                self.record(
+                    model, time.time() - start, queries[0], queue.qsize(),
+                    error
+                )
+
+    def snapshot(self):
+        "Return the stats of every method model as a dictionary"
+        with self._lock:
+            return dict(
+                (model, stats.as_dict())
+                for model, stats in self._methods.iteritems()
+            )
+
+    def reset(self):
+        with self._lock:
+            self._methods.clear()
+
+
+#: The stats of this process
+rate_stats = RateStats()
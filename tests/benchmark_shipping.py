@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark_shipping
+
+    Benchmarks of the shipping quote path
+
+    The benchmarks are not a part of the test suite. Run them with
+    ``python setup.py benchmark`` or by running this module. The size of
+    the synthetic data is read from the environment:
+
+        BENCHMARK_COUNTRIES     Countries the websites ship to (200)
+        BENCHMARK_TABLE_LINES   Lines of each shipping table (2000)
+        BENCHMARK_CART_LINES    Lines of the cart (100)
+        BENCHMARK_WEBSITES      Other websites with their own methods (3)
+        BENCHMARK_ITERATIONS    Measured runs of each operation (50)
+        BENCHMARK_RESULTS       File to which the results are written as
+                                JSON (benchmark-results.json)
+
+    :copyright: © 2013 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import os
+import sys
+import json
+import math
+import time
+from decimal import Decimal
+from urllib import urlencode
+from contextlib import contextmanager
+
+DIR = os.path.abspath(os.path.normpath(os.path.join(
+    __file__, '..', '..', '..', '..', '..', 'trytond')))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+import unittest
+import pycountry
+from mock import patch
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond.transaction import Transaction
+from nereid.globals import session
+
+from test_shipping import TestShipping
+
+COUNTRIES = int(os.environ.get('BENCHMARK_COUNTRIES', 200))
+TABLE_LINES = int(os.environ.get('BENCHMARK_TABLE_LINES', 2000))
+CART_LINES = int(os.environ.get('BENCHMARK_CART_LINES', 100))
+WEBSITES = int(os.environ.get('BENCHMARK_WEBSITES', 3))
+ITERATIONS = int(os.environ.get('BENCHMARK_ITERATIONS', 50))
+RESULTS = os.environ.get('BENCHMARK_RESULTS', 'benchmark-results.json')
+
+
+def percentile(values, percent):
+    "Return the percentile of the sorted values, by the nearest rank"
+    return values[max(int(math.ceil(percent / 100.0 * len(values))) - 1, 0)]
+
+
+class Timings(object):
+    """
+    The latencies and the number of queries of the runs of an operation
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.queries = []
+
+    @contextmanager
+    def measure(self):
+        "Measure the block as a run of the operation"
+        cursor = Transaction().cursor
+        with patch.object(cursor, 'execute', wraps=cursor.execute) as execute:
+            start = time.time()
+            yield
+            self.latencies.append((time.time() - start) * 1000)
+        self.queries.append(execute.call_count)
+
+    def summary(self):
+        "Return a dictionary of the percentiles of the runs"
+        latencies = sorted(self.latencies)
+        queries = sorted(self.queries)
+        return {
+            'runs': len(latencies),
+            'latency_ms': {
+                'min': latencies[0],
+                'mean': sum(latencies) / len(latencies),
+                'p50': percentile(latencies, 50),
+                'p90': percentile(latencies, 90),
+                'p99': percentile(latencies, 99),
+                'max': latencies[-1],
+            },
+            'queries': {
+                'mean': float(sum(queries)) / len(queries),
+                'p50': percentile(queries, 50),
+                'max': queries[-1],
+            },
+        }
+
+
+class ShippingBenchmark(TestShipping):
+    """Benchmark the shipping quote path"""
+
+    #: Summaries of the benchmarks by name, written to RESULTS by
+    #: write_results once the suite ran
+    results = {}
+
+    def measure(self, name, function, before=None):
+        """Run the function ITERATIONS times and record its timings under
+        the name
+
+        :param before: Function called before each run, which is not
+                       measured
+        """
+        timings = Timings()
+        for iteration in xrange(ITERATIONS):
+            if before is not None:
+                before()
+            with timings.measure():
+                function()
+        self.results[name] = timings.summary()
+
+    def setup_benchmark(self):
+        """Create a large configuration on top of the defaults: every
+        website ships to all the countries with a flat rate, a free rate
+        and a table of TABLE_LINES lines.
+        """
+        self.setup_defaults()
+
+        self.Country.create([{
+            'name': country.name,
+            'code': country.alpha2,
+        } for country in list(pycountry.countries)[5:5 + COUNTRIES]])
+        countries = self.Country.search([])
+        self.Website.write([self.website], {
+            'countries': [('set', [c.id for c in countries])],
+        })
+        self.country = self.website.countries[0]
+        self.subdivision = self.country.subdivisions[0]
+
+        websites = [self.website] + [
+            self.Website.copy([self.website], {
+                'name': 'benchmark-%d' % index,
+            })[0] for index in xrange(WEBSITES)
+        ]
+        for website in websites:
+            self._create_benchmark_methods(website, countries)
+
+    def _create_benchmark_methods(self, website, countries):
+        "Create the shipping methods of a website for the benchmark"
+        flat, free, table = self.Shipping.create([{
+            'name': name,
+            'available_countries': [('add', [c.id for c in countries])],
+            'website': website.id,
+        } for name in ('Flat Rate', 'Free Rate', 'Table Rate')])
+
+        self.Flat.create([{'shipping': flat.id, 'price': Decimal('10')}])
+        self.Free.create([{
+            'shipping': free.id, 'minimum_order_value': Decimal('100000'),
+        }])
+        table, = self.Table.create([{
+            'shipping': table.id, 'factor': 'total_price',
+        }])
+
+        lines = []
+        for index in xrange(TABLE_LINES):
+            country = countries[index % len(countries)]
+            values = {
+                'table': table.id,
+                'country': country.id,
+                'factor': float(index // len(countries) * 10),
+                'price': Decimal(index % 50 + 1),
+            }
+            if country == self.country and index % 2:
+                values['subdivision'] = self.subdivision.id
+                values['zip'] = '682013'
+            lines.append(values)
+        self.TableLine.create(lines)
+
+    def fill_cart(self, client):
+        """Add CART_LINES lines to the cart of the client and return the
+        sale of the cart
+        """
+        Cart = POOL.get('nereid.cart')
+        SaleLine = POOL.get('sale.line')
+
+        client.post('/cart/add', data={
+            'product': self.product.id, 'quantity': 1
+        })
+        sale = Cart.open_cart().sale
+        SaleLine.create([{
+            'sale': sale.id,
+            'type': 'line',
+            'product': self.product.id,
+            'description': 'Line %d' % index,
+            'quantity': index % 5 + 1,
+            'unit': self.product.sale_uom.id,
+            'unit_price': Decimal('10'),
+        } for index in xrange(CART_LINES - 1)])
+        return sale
+
+    def bench_0010_quote(self):
+        """Quote a destination: the whole quote, cold, without the quote
+        cache and from the quote cache, and the get_rate of each method.
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_benchmark()
+            app = self.get_app()
+            destination = {
+                'zip': '682013',
+                'subdivision': self.subdivision.id,
+                'country': self.country.id,
+            }
+
+            with app.test_client() as c:
+                self.fill_cart(c)
+
+                def quote():
+                    self.Shipping._get_available_methods(**destination)
+
+                app.config['SHIPPING_QUOTE_CACHE_TTL'] = 0
+                self.measure(
+                    'quote.cold', quote,
+                    before=self.Shipping.clear_config_cache
+                )
+                self.measure('quote.uncached', quote)
+                app.config['SHIPPING_QUOTE_CACHE_TTL'] = 300
+                self.measure('quote.cached', quote)
+
+                c.get('/_available_shipping_methods?' + urlencode(
+                    destination
+                ))
+                self.measure('quote.request', lambda: c.get(
+                    '/_available_shipping_methods?' + urlencode(destination)
+                ))
+
+                for model in self.Shipping.get_method_models():
+                    kwargs = dict(
+                        destination,
+                        quote_context=self.Shipping.get_quote_context()
+                    )
+                    self.measure(
+                        'get_rate.%s' % model,
+                        lambda: self.Shipping._get_method_rates(
+                            model, **kwargs
+                        )
+                    )
+
+    def bench_0020_add_shipping_line(self):
+        """Add the shipping line of the selected method, with a valid
+        quote in the session, a stale one, and without any.
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_benchmark()
+            app = self.get_app()
+            url = '/_available_shipping_methods?' + urlencode({
+                'zip': '682013',
+                'subdivision': self.subdivision.id,
+                'country': self.country.id,
+            })
+
+            with app.test_client() as c:
+                sale = self.fill_cart(c)
+                address, = self.Address.create([{
+                    'party': sale.party.id,
+                    'name': 'Benchmark',
+                    'zip': '682013',
+                    'subdivision': self.subdivision.id,
+                    'country': self.country.id,
+                }])
+                sale.shipment_address = address
+                sale.save()
+                flat_rate, = self.Flat.search([
+                    ('shipping.website', '=', self.website.id),
+                ])
+
+                def add_shipping_line():
+                    self.Shipping.add_shipping_line(
+                        self.Sale(sale.id), flat_rate.id
+                    )
+
+                def stale_quote():
+                    c.get(url)
+                    session['shipping_quote'] = [
+                        self.Shipping.dump_quote_token(option, 'stale')
+                        for option, key in map(
+                            self.Shipping.load_quote_token,
+                            session['shipping_quote']
+                        )
+                    ]
+
+                self.measure(
+                    'add_shipping_line.quoted', add_shipping_line,
+                    before=lambda: c.get(url)
+                )
+                self.measure(
+                    'add_shipping_line.stale', add_shipping_line,
+                    before=stale_quote
+                )
+                self.measure(
+                    'add_shipping_line.unquoted', add_shipping_line,
+                    before=lambda: session.pop('shipping_quote', None)
+                )
+
+
+def suite():
+    "Shipping benchmark suite"
+    loader = unittest.TestLoader()
+    loader.testMethodPrefix = 'bench'
+    return loader.loadTestsFromTestCase(ShippingBenchmark)
+
+
+def write_results():
+    "Write the results of the benchmarks which ran to RESULTS"
+    with open(RESULTS, 'w') as stream:
+        json.dump({
+            'created': time.time(),
+            'python': sys.version.split()[0],
+            'parameters': {
+                'countries': COUNTRIES,
+                'table_lines': TABLE_LINES,
+                'cart_lines': CART_LINES,
+                'websites': WEBSITES,
+                'iterations': ITERATIONS,
+            },
+            'benchmarks': ShippingBenchmark.results,
+        }, stream, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
+    write_results()
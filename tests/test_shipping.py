@@ -10,8 +10,20 @@
 import os
 import sys
 import json
+import logging
+import time
+import socket
+import shutil
+import tempfile
+import threading
 from decimal import Decimal
 from urllib import urlencode
+from urlparse import urlsplit, parse_qs
+from StringIO import StringIO
+from contextlib import nested
+from SocketServer import ThreadingMixIn, ThreadingTCPServer, \
+    StreamRequestHandler
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 
 DIR = os.path.abspath(os.path.normpath(os.path.join(
     __file__, '..', '..', '..', '..', '..', 'trytond')))
@@ -21,14 +33,86 @@ if os.path.isdir(DIR):
 import unittest
 import pycountry
 from mock import patch
+from werkzeug.exceptions import Forbidden
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
 from trytond.config import CONFIG
 CONFIG['smtp_from'] = "testing@openlabs.co.in"
 
 from trytond.transaction import Transaction
+from trytond.exceptions import UserError
 
 from nereid.testing import NereidTestCase
+from nereid.globals import session
+
+
+class StubCarrierHandler(BaseHTTPRequestHandler):
+    """Rating API of a stub carrier, which quotes the `amount` of the query
+    string after `delay` seconds
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        query = parse_qs(urlsplit(self.path).query)
+        time.sleep(float(query.get('delay', [0])[0]))
+        body = json.dumps({'amount': float(query['amount'][0])})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+class StubCarrierServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    connections = 0
+
+
+class StubRedisHandler(StreamRequestHandler):
+    """Stand-in for a Redis server, which knows only the commands used by
+    the shared cache and ignores the expiry of the keys
+    """
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for i in xrange(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2])
+            self.server.commands.append(args[0])
+            if args[0] == 'GET':
+                value = self.server.store.get(args[1])
+                self.wfile.write(
+                    '$-1\r\n' if value is None
+                    else '$%d\r\n%s\r\n' % (len(value), value)
+                )
+            else:
+                if args[0] == 'SET':
+                    self.server.store[args[1]] = args[2]
+                self.wfile.write('+OK\r\n')
+
+
+class StubRedisServer(ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self, *args):
+        ThreadingTCPServer.__init__(self, *args)
+        self.store = {}
+        self.commands = []
 
 
 class TestShipping(NereidTestCase):
@@ -358,6 +442,10 @@ class TestShipping(NereidTestCase):
         )
         self.product = self.template.products[0]
 
+        # The database is created again for each test, so drop what was
+        # cached from the previous one
+        self.Shipping.clear_config_cache()
+
     def test_0010_check_cart(self):
         """Assert nothing broke the cart."""
         with Transaction().start(DB_NAME, USER, CONTEXT):
@@ -823,6 +911,1744 @@ class TestShipping(NereidTestCase):
                 self.assertEqual(len(sale.lines), 2)
                 self.assertEqual(sale.state, 'confirmed')
 
+    def test_0080_concurrent_rates(self):
+        """Rates must be computed concurrently when rate workers are
+        configured, and methods exceeding the timeout must be skipped
+        """
+        def get_rate_after(delay, amount):
+            def get_rate(cls, queue, **kwargs):
+                time.sleep(delay)
+                queue.put({'id': 1, 'name': cls.__name__, 'amount': amount})
+            return classmethod(get_rate)
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            country = self.website.countries[0]
+            subdivision = country.subdivisions[0]
+            app = self.get_app(
+                SHIPPING_RATE_WORKERS=3, SHIPPING_RATE_TIMEOUT=1
+            )
+            for Method, values in (
+                    (self.Flat, {'price': Decimal('10.0')}),
+                    (self.Free, {}),
+                    (self.Table, {'factor': 'total_price'})):
+                values['shipping'] = self._create_shipping(Method.__name__).id
+                Method.create([values])
+
+            with nested(
+                    patch.object(
+                        self.Flat, 'get_rate', get_rate_after(0.5, 10.0)),
+                    patch.object(
+                        self.Free, 'get_rate', get_rate_after(0.5, 0.0)),
+                    patch.object(
+                        self.Table, 'get_rate', get_rate_after(3, 25.0)),
+                    patch.object(
+                        self.Shipping._quote_cache, 'set')) as (
+                            _, _, _, cache_set):
+                with app.test_client() as c:
+                    url = '/_available_shipping_methods?' + urlencode({
+                        'zip': '682013',
+                        'subdivision': subdivision.id,
+                        'country': country.id,
+                    })
+                    start = time.time()
+                    result = c.get(url)
+                    elapsed = time.time() - start
+
+            self.assertEqual(
+                json.loads(result.data), {u'result': [
+                    [1, u'nereid.shipping.method.flat', 10.0],
+                    [1, u'nereid.shipping.method.free', 0.0],
+                ]}
+            )
+            # The methods run together and the table method is dropped
+            # after the timeout of a second
+            self.assertTrue(elapsed < 2)
+            # The incomplete quote is not cached
+            self.assertEqual(cache_set.call_count, 0)
+
+            # More methods time out than there are workers, so the last
+            # method starts only after the timeout of the others
+            app = self.get_app(
+                SHIPPING_RATE_WORKERS=2, SHIPPING_RATE_TIMEOUT=1
+            )
+            with nested(
+                    patch.object(
+                        self.Flat, 'get_rate', get_rate_after(1.5, 10.0)),
+                    patch.object(
+                        self.Free, 'get_rate', get_rate_after(1.5, 0.0)),
+                    patch.object(
+                        self.Table, 'get_rate', get_rate_after(0, 25.0))):
+                with app.test_client() as c:
+                    result = c.get(url)
+
+            self.assertEqual(result.status_code, 200)
+            self.assertEqual(
+                json.loads(result.data), {u'result': [
+                    [1, u'nereid.shipping.method.table', 25.0],
+                ]}
+            )
+
+    def test_0090_method_models_registry(self):
+        """The shipping method models must be looked up only once and
+        registered rate providers must be included
+        """
+        Model = POOL.get('ir.model')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.Shipping._method_models_cache.clear()
+
+            with patch.object(Model, 'search', wraps=Model.search) as search:
+                method_models = self.Shipping.get_method_models()
+                self.assertEqual(self.Shipping.get_method_models(), [
+                    'nereid.shipping.method.flat',
+                    'nereid.shipping.method.free',
+                    'nereid.shipping.method.table',
+                ])
+                self.assertEqual(search.call_count, 1)
+
+                # The pool is set up again when modules are installed or
+                # updated
+                self.Shipping.__post_setup__()
+                self.Shipping.get_method_models()
+                self.assertEqual(search.call_count, 2)
+
+            with patch.object(self.Shipping, '_rate_providers', []):
+                self.Shipping.register_rate_provider('carrier.rate')
+                self.Shipping.register_rate_provider('carrier.rate')
+                self.assertEqual(
+                    self.Shipping.get_method_models(),
+                    method_models + ['carrier.rate']
+                )
+
+    def test_0100_rate_plan(self):
+        """The rate plan of a website must index the method records by
+        country and guest eligibility, and be compiled again only when the
+        configuration changes
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            country1, country2 = self.website.countries[0:2]
+
+            ship_flat = self._create_shipping('Flat Rate')
+            ship_table = self._create_shipping('Table Rate')
+            self.Shipping.write([ship_table], {
+                'available_countries': [('unlink', [country2.id])],
+                'is_allowed_for_guest': False,
+            })
+            flat_rate, = self.Flat.create([{
+                'shipping': ship_flat.id,
+                'price': Decimal('10.0'),
+            }])
+            table, = self.Table.create([{
+                'shipping': ship_table.id,
+                'factor': 'total_price',
+            }])
+
+            plan = self.Shipping.get_rate_plan(self.website)
+            self.assertTrue(self.Shipping.get_rate_plan(self.website) is plan)
+            for guest in (True, False):
+                self.assertEqual(
+                    plan.lookup(self.Flat.__name__, country1.id, guest),
+                    (flat_rate.id,)
+                )
+                self.assertEqual(
+                    plan.lookup(self.Flat.__name__, country2.id, guest),
+                    (flat_rate.id,)
+                )
+            self.assertEqual(
+                plan.lookup(self.Table.__name__, country1.id), (table.id,)
+            )
+            self.assertEqual(
+                plan.lookup(self.Table.__name__, country1.id, True), ()
+            )
+            self.assertEqual(
+                plan.lookup(self.Table.__name__, country2.id), ()
+            )
+
+            ship_flat.active = False
+            ship_flat.save()
+            plan = self.Shipping.get_rate_plan(self.website)
+            self.assertEqual(
+                plan.lookup(self.Flat.__name__, country1.id), ()
+            )
+
+    def test_0110_slab_index(self):
+        """The slab indexes of a table must find the price of the highest
+        slab below the value, falling back to less specific lines
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            country = self.website.countries[0]
+            subdivision = country.subdivisions[0]
+
+            table, = self.Table.create([{
+                'shipping': self._create_shipping('Table Rate').id,
+                'factor': 'total_price',
+            }])
+            self.TableLine.create([{
+                'country': country.id,
+                'subdivision': subdivision.id,
+                'zip': '682013',
+                'factor': factor,
+                'price': Decimal(factor) / 10,
+                'table': table.id,
+            } for factor in xrange(100, 1000, 100)] + [{
+                'country': country.id,
+                'factor': 0,
+                'price': Decimal('99'),
+                'table': table.id,
+            }])
+
+            slab_indexes = self.Table.get_slab_indexes(
+                table, country.id, subdivision.id, '682013'
+            )
+            self.assertEqual(len(slab_indexes), 2)
+            self.assertEqual(slab_indexes[0].find(50), None)
+            self.assertEqual(slab_indexes[1].find(50), 99.0)
+            self.assertEqual(slab_indexes[0].find(100), 10.0)
+            self.assertEqual(slab_indexes[0].find(Decimal('450.5')), 40.0)
+            self.assertEqual(slab_indexes[0].find(5000), 90.0)
+            self.assertTrue(self.Table.get_slab_indexes(
+                table, country.id, subdivision.id, '682013'
+            ) is slab_indexes)
+
+            # Only the country wide line matches another zip
+            slab_indexes = self.Table.get_slab_indexes(
+                table, country.id, subdivision.id, '682014'
+            )
+            self.assertEqual(len(slab_indexes), 1)
+            self.assertEqual(slab_indexes[0].find(5000), 99.0)
+
+            self.TableLine.create([{
+                'country': country.id,
+                'subdivision': subdivision.id,
+                'zip': '682014',
+                'factor': 0,
+                'price': Decimal('5'),
+                'table': table.id,
+            }])
+            slab_indexes = self.Table.get_slab_indexes(
+                table, country.id, subdivision.id, '682014'
+            )
+            self.assertEqual(len(slab_indexes), 2)
+            self.assertEqual(slab_indexes[0].find(5000), 5.0)
+
+            # All the candidate lines are fetched in a single search
+            self.Table._slab_cache.clear()
+            with patch.object(
+                    self.TableLine, 'search',
+                    wraps=self.TableLine.search) as search:
+                slab_indexes = self.Table.get_slab_indexes(
+                    table, country.id, subdivision.id, '682013'
+                )
+                self.assertEqual(search.call_count, 1)
+            self.assertEqual(len(slab_indexes), 2)
+            self.assertEqual(slab_indexes[0].find(450), 40.0)
+
+    def test_0120_weight_and_quantity_factor(self):
+        """Tables must be able to charge on the total weight or quantity of
+        the cart, which are kept up to date on the sale
+        """
+        SaleLine = POOL.get('sale.line')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            country = self.website.countries[0]
+            subdivision = country.subdivisions[0]
+            app = self.get_app()
+
+            gram, = self.Uom.search([('name', '=', 'Gram')])
+            self.template.weight = 500
+            self.template.weight_uom = gram
+            self.template.save()
+
+            table, = self.Table.create([{
+                'shipping': self._create_shipping('Table Rate').id,
+                'factor': 'total_weight',
+            }])
+            self.TableLine.create([{
+                'country': country.id,
+                'factor': factor,
+                'price': price,
+                'table': table.id,
+            } for factor, price in [
+                (0, Decimal('5')), (10, Decimal('20')), (20, Decimal('2')),
+            ]])
+
+            url = '/_available_shipping_methods?' + urlencode({
+                'zip': '682013',
+                'subdivision': subdivision.id,
+                'country': country.id,
+            })
+            with app.test_client() as c:
+                c.post('/cart/add', data={
+                    'product': self.product.id, 'quantity': 10
+                })
+                sale, = self.Sale.search([])
+                self.assertEqual(sale.shipping_weight, 5.0)
+                self.assertEqual(sale.shipping_quantity, 10.0)
+                result = c.get(url)
+                self.assertEqual(
+                    json.loads(result.data),
+                    {u'result': [[table.id, u'Table Rate', 5.0]]}
+                )
+
+                c.post('/cart/add', data={
+                    'product': self.product.id, 'quantity': 30
+                })
+                sale = self.Sale(sale.id)
+                self.assertEqual(sale.shipping_weight, 15.0)
+                self.assertEqual(sale.shipping_quantity, 30.0)
+                result = c.get(url)
+                self.assertEqual(
+                    json.loads(result.data),
+                    {u'result': [[table.id, u'Table Rate', 20.0]]}
+                )
+
+                table.factor = 'total_quantity'
+                table.save()
+                result = c.get(url)
+                self.assertEqual(
+                    json.loads(result.data),
+                    {u'result': [[table.id, u'Table Rate', 2.0]]}
+                )
+
+                c.get('/cart/delete/%d' % sale.lines[0].id)
+                sale = self.Sale(sale.id)
+                self.assertEqual(sale.shipping_weight, 0.0)
+                self.assertEqual(sale.shipping_quantity, 0.0)
+
+                # Adding and removing lines does not drift the totals away
+                # from the breakpoint of a slab
+                self.template.weight = 100
+                self.template.save()
+                table.factor = 'total_weight'
+                table.save()
+                self.TableLine.create([{
+                    'country': country.id,
+                    'factor': 0.2,
+                    'price': Decimal('7'),
+                    'table': table.id,
+                }])
+                line1, line2 = SaleLine.create([{
+                    'sale': sale.id,
+                    'product': self.product.id,
+                    'description': self.product.name,
+                    'unit': self.product.default_uom.id,
+                    'unit_price': Decimal('10'),
+                    'quantity': quantity,
+                } for quantity in (3, 2)])
+                SaleLine.delete([line1])
+                sale = self.Sale(sale.id)
+                self.assertEqual(sale.shipping_weight, 0.2)
+                self.assertEqual(sale.shipping_quantity, 2.0)
+                result = c.get(url)
+                self.assertEqual(
+                    json.loads(result.data),
+                    {u'result': [[table.id, u'Table Rate', 7.0]]}
+                )
+
+    def test_0130_quote_cache(self):
+        """Quotes must be cached for the same destination and cart, until
+        the cart or the configuration changes
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            country = self.website.countries[0]
+            subdivision = country.subdivisions[0]
+            app = self.get_app()
+
+            flat_rate, = self.Flat.create([{
+                'shipping': self._create_shipping('Flat Rate').id,
+                'price': Decimal('10.0'),
+            }])
+
+            url = '/_available_shipping_methods?' + urlencode({
+                'zip': '682013',
+                'subdivision': subdivision.id,
+                'country': country.id,
+            })
+            with patch.object(
+                    self.Flat, 'get_rate',
+                    wraps=self.Flat.get_rate) as get_rate:
+                with app.test_client() as c:
+                    c.post('/cart/add', data={
+                        'product': self.product.id, 'quantity': 1
+                    })
+                    c.get(url)
+                    result = c.get(url)
+                    self.assertEqual(get_rate.call_count, 1)
+                    self.assertEqual(json.loads(result.data), {
+                        u'result': [[flat_rate.id, u'Flat Rate', 10.0]]
+                    })
+
+                    # Another destination
+                    c.get(url.replace('682013', '682014'))
+                    self.assertEqual(get_rate.call_count, 2)
+
+                    # Changes to the cart
+                    c.post('/cart/add', data={
+                        'product': self.product.id, 'quantity': 2
+                    })
+                    c.get(url)
+                    self.assertEqual(get_rate.call_count, 3)
+
+                    # Changes to the configuration
+                    flat_rate.price = Decimal('12.0')
+                    flat_rate.save()
+                    result = c.get(url)
+                    self.assertEqual(get_rate.call_count, 4)
+                    self.assertEqual(json.loads(result.data), {
+                        u'result': [[flat_rate.id, u'Flat Rate', 12.0]]
+                    })
+
+            # The names of the methods are translated, and the amounts
+            # could depend on the currency and price list
+            with app.test_request_context('/'):
+                destination = {
+                    'country': country.id,
+                    'quote_context': self.Shipping.get_quote_context(),
+                }
+                key = self.Shipping._get_quote_key(**destination)
+                for context in (
+                        {'language': 'fr_FR'}, {'price_list': 1},
+                        {'currency': -1}):
+                    with Transaction().set_context(**context):
+                        self.assertNotEqual(
+                            self.Shipping._get_quote_key(**destination), key
+                        )
+
+            app = self.get_app(SHIPPING_QUOTE_CACHE_TTL=0)
+            with patch.object(
+                    self.Flat, 'get_rate',
+                    wraps=self.Flat.get_rate) as get_rate:
+                with app.test_client() as c:
+                    c.get(url)
+                    c.get(url)
+                    self.assertEqual(get_rate.call_count, 2)
+
+    def test_0140_add_shipping_line(self):
+        """The rate of the selected method must be taken from the quote in
+        the session, and only the selected method must be priced again when
+        the quote is no longer valid.
+        """
+        from trytond.modules.nereid_shipping.quote import RateOption
+        Cart = POOL.get('nereid.cart')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            country = self.website.countries[0]
+            subdivision = country.subdivisions[0]
+            app = self.get_app(SHIPPING_QUOTE_CACHE_TTL=0)
+
+            flat_rate, = self.Flat.create([{
+                'shipping': self._create_shipping('Flat Rate').id,
+                'price': Decimal('10.0'),
+            }])
+            self.Free.create([{
+                'shipping': self._create_shipping('Free Rate').id,
+                'minimum_order_value': Decimal('1000.0'),
+            }])
+
+            url = '/_available_shipping_methods?' + urlencode({
+                'zip': '682013',
+                'subdivision': subdivision.id,
+                'country': country.id,
+            })
+            with nested(
+                    patch.object(
+                        self.Flat, 'get_rate', wraps=self.Flat.get_rate),
+                    patch.object(
+                        self.Free, 'get_rate', wraps=self.Free.get_rate),
+                    app.test_client()) as (flat_get_rate, free_get_rate, c):
+                c.post('/cart/add', data={
+                    'product': self.product.id, 'quantity': 1
+                })
+                sale = Cart.open_cart().sale
+                address, = self.Address.create([{
+                    'party': sale.party.id,
+                    'name': 'Guest',
+                    'zip': '682013',
+                    'subdivision': subdivision.id,
+                    'country': country.id,
+                }])
+                sale.shipment_address = address
+                sale.save()
+
+                c.get(url)
+                self.assertEqual(flat_get_rate.call_count, 1)
+                self.assertEqual(free_get_rate.call_count, 1)
+
+                # The quote is still valid
+                sale = self.Sale(sale.id)
+                self.Shipping.add_shipping_line(sale, flat_rate.id)
+                self.assertEqual(flat_get_rate.call_count, 1)
+                self.assertEqual(free_get_rate.call_count, 1)
+                line, = [l for l in sale.lines if l.is_shipping_line]
+                self.assertEqual(line.unit_price, Decimal('10.0'))
+
+                # The shipping line changed the cart, so only the selected
+                # method is priced again and the line is updated
+                flat_rate.price = Decimal('12.0')
+                flat_rate.save()
+                sale = self.Sale(sale.id)
+                self.Shipping.add_shipping_line(sale, flat_rate.id)
+                self.assertEqual(flat_get_rate.call_count, 2)
+                self.assertEqual(free_get_rate.call_count, 1)
+                line, = [l for l in sale.lines if l.is_shipping_line]
+                self.assertEqual(line.unit_price, Decimal('12.0'))
+
+                # A method which was not quoted is looked for in a new
+                # quote of every method
+                self.assertRaises(
+                    Forbidden, self.Shipping.add_shipping_line,
+                    sale, flat_rate.id + 1000
+                )
+                self.assertEqual(free_get_rate.call_count, 2)
+
+                # A method quoted elsewhere than in the session, like by a
+                # stream or for another destination
+                session['shipping_quote'] = [
+                    self.Shipping.dump_quote_token(RateOption(
+                        flat_rate.id + 1000, u'Other', 1.0, self.Free.__name__
+                    ), 'other')
+                ]
+                self.Shipping.add_shipping_line(sale, flat_rate.id)
+                self.assertEqual(free_get_rate.call_count, 3)
+
+    def test_0150_single_cart_load(self):
+        """The cart must be loaded once per quote, whatever the number of
+        methods which depend on it
+        """
+        Cart = POOL.get('nereid.cart')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            country = self.website.countries[0]
+            subdivision = country.subdivisions[0]
+            app = self.get_app(SHIPPING_QUOTE_CACHE_TTL=0)
+
+            url = '/_available_shipping_methods?' + urlencode({
+                'zip': '682013',
+                'subdivision': subdivision.id,
+                'country': country.id,
+            })
+            with app.test_client() as c:
+                c.post('/cart/add', data={
+                    'product': self.product.id, 'quantity': 3
+                })
+
+                # The cart is also opened by cart_b2c on each request, so
+                # compare with a quote without any method
+                with patch.object(
+                        Cart, 'open_cart', wraps=Cart.open_cart) as open_cart:
+                    c.get(url)
+                    baseline = open_cart.call_count
+
+                free_rate, = self.Free.create([{
+                    'shipping': self._create_shipping('Free Rate').id,
+                    'minimum_order_value': Decimal('20.0'),
+                }])
+                table, = self.Table.create([{
+                    'shipping': self._create_shipping('Table Rate').id,
+                    'factor': 'total_price',
+                    'lines': [('create', [{
+                        'factor': 10.0,
+                        'price': Decimal('5.0'),
+                    }])],
+                }])
+                with patch.object(
+                        Cart, 'open_cart', wraps=Cart.open_cart) as open_cart:
+                    result = c.get(url)
+                    self.assertEqual(open_cart.call_count, baseline)
+                self.assertEqual(json.loads(result.data), {u'result': [
+                    [free_rate.id, u'Free Rate', 0.0],
+                    [table.id, u'Table Rate', 5.0],
+                ]})
+
+    def test_0160_batch_quote(self):
+        """Quote a list of destinations at once, with a single search of
+        the table lines for the whole batch
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            country1, country2 = self.website.countries[:2]
+            subdivision1 = country1.subdivisions[0]
+            subdivision2 = country2.subdivisions[0]
+            app = self.get_app()
+
+            flat_rate, = self.Flat.create([{
+                'shipping': self._create_shipping('Flat Rate').id,
+                'price': Decimal('10.0'),
+            }])
+            table, = self.Table.create([{
+                'shipping': self._create_shipping('Table Rate').id,
+                'factor': 'total_price',
+                'lines': [('create', [{
+                    'country': country1.id,
+                    'factor': 0.0,
+                    'price': Decimal('5.0'),
+                }, {
+                    'country': country1.id,
+                    'factor': 100.0,
+                    'price': Decimal('2.0'),
+                }, {
+                    'country': country2.id,
+                    'subdivision': subdivision2.id,
+                    'factor': 0.0,
+                    'price': Decimal('7.0'),
+                }])],
+            }])
+
+            destinations = [{
+                'country': country1.id,
+                'subdivision': subdivision1.id,
+                'zip': '682013',
+            }, {
+                'country': country2.id,
+                'subdivision': subdivision2.id,
+            }, {
+                'country': country1.id,
+                'subdivision': subdivision1.id,
+                'zip': '682013',
+            }, {
+                'country': country1.id,
+                'cart': {'total_amount': 150, 'weight': 1, 'quantity': 2},
+            }]
+            with nested(
+                    patch.object(
+                        self.TableLine, 'search',
+                        wraps=self.TableLine.search),
+                    app.test_client()) as (search, c):
+                c.post('/cart/add', data={
+                    'product': self.product.id, 'quantity': 1
+                })
+                result = c.post(
+                    '/_available_shipping_methods/batch',
+                    data=json.dumps({'destinations': destinations}),
+                    content_type='application/json'
+                )
+                self.assertEqual(search.call_count, 1)
+
+            self.assertEqual(json.loads(result.data), {u'result': [
+                [[flat_rate.id, u'Flat Rate', 10.0],
+                    [table.id, u'Table Rate', 5.0]],
+                [[flat_rate.id, u'Flat Rate', 10.0],
+                    [table.id, u'Table Rate', 7.0]],
+                [[flat_rate.id, u'Flat Rate', 10.0],
+                    [table.id, u'Table Rate', 5.0]],
+                [[flat_rate.id, u'Flat Rate', 10.0],
+                    [table.id, u'Table Rate', 2.0]],
+            ]})
+
+            with app.test_client() as c:
+                for data in ({}, {'destinations': [{'zip': '682013'}]}):
+                    result = c.post(
+                        '/_available_shipping_methods/batch',
+                        data=json.dumps(data),
+                        content_type='application/json'
+                    )
+                    self.assertEqual(result.status_code, 400)
+
+    def test_0170_rate_stats(self):
+        """The rate computation of each method must be recorded in the
+        stats and logged
+        """
+        from trytond.modules.nereid_shipping.stats import rate_stats, logger
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            country = self.website.countries[0]
+            subdivision = country.subdivisions[0]
+            app = self.get_app(SHIPPING_QUOTE_CACHE_TTL=0)
+
+            self.Flat.create([{
+                'shipping': self._create_shipping('Flat Rate').id,
+                'price': Decimal('10.0'),
+            }])
+            destination = {
+                'zip': '682013',
+                'subdivision': subdivision.id,
+                'country': country.id,
+            }
+
+            records = []
+            handler = logging.Handler(logging.INFO)
+            handler.emit = records.append
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            rate_stats.reset()
+            try:
+                with app.test_client() as c:
+                    c.get('/_available_shipping_methods?' + urlencode(
+                        destination
+                    ))
+                    with patch.object(
+                            self.Flat, 'get_rate', side_effect=ValueError):
+                        self.assertRaises(
+                            ValueError, self.Shipping._get_method_rates,
+                            self.Flat.__name__, **destination
+                        )
+            finally:
+                logger.removeHandler(handler)
+                logger.setLevel(logging.NOTSET)
+
+            stats = self.Shipping.get_rate_stats()
+            flat_stats = stats[self.Flat.__name__]
+            self.assertEqual(flat_stats['calls'], 2)
+            self.assertEqual(flat_stats['errors'], 1)
+            self.assertEqual(flat_stats['options'], 1)
+            self.assertEqual(flat_stats['time']['count'], 2)
+            self.assertTrue(flat_stats['queries']['sum'] > 0)
+            # The table method has no records, so it is not dispatched
+            self.assertFalse(self.Table.__name__ in stats)
+
+            flat_records = [
+                r.shipping_rate for r in records
+                if r.shipping_rate['model'] == self.Flat.__name__
+            ]
+            self.assertEqual(
+                [(r['options'], r['error']) for r in flat_records],
+                [(1, False), (0, True)]
+            )
+
+    def test_0180_stream_quote(self):
+        """Stream the options of each method as newline delimited JSON,
+        ending with a completion marker
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            country = self.website.countries[0]
+            subdivision = country.subdivisions[0]
+            app = self.get_app()
+
+            flat_rate, = self.Flat.create([{
+                'shipping': self._create_shipping('Flat Rate').id,
+                'price': Decimal('10.0'),
+            }])
+            table, = self.Table.create([{
+                'shipping': self._create_shipping('Table Rate').id,
+                'factor': 'total_price',
+                'lines': [('create', [{
+                    'factor': 0.0,
+                    'price': Decimal('5.0'),
+                }])],
+            }])
+
+            url = '/_available_shipping_methods/stream?' + urlencode({
+                'zip': '682013',
+                'subdivision': subdivision.id,
+                'country': country.id,
+            })
+            with patch.object(
+                    self.Flat, 'get_rate',
+                    wraps=self.Flat.get_rate) as get_rate:
+                with app.test_client() as c:
+                    c.post('/cart/add', data={
+                        'product': self.product.id, 'quantity': 1
+                    })
+                    for i in range(2):
+                        result = c.get(url)
+                        self.assertEqual(
+                            result.mimetype, 'application/x-ndjson'
+                        )
+                        self.assertEqual(
+                            map(json.loads, result.data.splitlines()), [
+                                {u'id': flat_rate.id, u'name': u'Flat Rate',
+                                    u'amount': 10.0},
+                                {u'id': table.id, u'name': u'Table Rate',
+                                    u'amount': 5.0},
+                                {u'done': True},
+                            ]
+                        )
+                # The second stream is served from the quote cache
+                self.assertEqual(get_rate.call_count, 1)
+
+    def test_0190_pruned_quote(self):
+        """Prune the options to the cheapest ones, the ones below a price or
+        the first available, skipping the methods which cannot change the
+        result
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            country = self.website.countries[0]
+            subdivision = country.subdivisions[0]
+            app = self.get_app(SHIPPING_QUOTE_CACHE_TTL=0)
+
+            flat_rate, = self.Flat.create([{
+                'shipping': self._create_shipping('Flat Rate').id,
+                'price': Decimal('10.0'),
+            }])
+            free_rate, = self.Free.create([{
+                'shipping': self._create_shipping('Free Rate').id,
+                'minimum_order_value': Decimal('0.0'),
+            }])
+            table, = self.Table.create([{
+                'shipping': self._create_shipping('Table Rate').id,
+                'factor': 'total_price',
+                'lines': [('create', [{
+                    'factor': 0.0,
+                    'price': Decimal('5.0'),
+                }])],
+            }])
+
+            def get_url(**pruning):
+                pruning.update({
+                    'zip': '682013',
+                    'subdivision': subdivision.id,
+                    'country': country.id,
+                })
+                return '/_available_shipping_methods?' + urlencode(pruning)
+
+            flat = [flat_rate.id, u'Flat Rate', 10.0]
+            free = [free_rate.id, u'Free Rate', 0.0]
+            table_rate = [table.id, u'Table Rate', 5.0]
+            with app.test_client() as c:
+                c.post('/cart/add', data={
+                    'product': self.product.id, 'quantity': 1
+                })
+                for pruning, expected, table_called in [
+                        ({'limit': 1}, [free], False),
+                        ({'first': 1}, [flat], False),
+                        ({'limit': 2}, [free, table_rate], True),
+                        ({'max_amount': 7}, [free, table_rate], True),
+                        ({}, [flat, free, table_rate], True)]:
+                    with patch.object(
+                            self.Table, 'get_rate',
+                            wraps=self.Table.get_rate) as get_rate:
+                        result = c.get(get_url(**pruning))
+                        self.assertEqual(get_rate.called, table_called)
+                    self.assertEqual(
+                        json.loads(result.data), {u'result': expected}
+                    )
+
+            # A cached quote is pruned without running any method
+            app = self.get_app()
+            with app.test_client() as c:
+                c.post('/cart/add', data={
+                    'product': self.product.id, 'quantity': 1
+                })
+                c.get(get_url())
+                with patch.object(
+                        self.Flat, 'get_rate',
+                        wraps=self.Flat.get_rate) as get_rate:
+                    result = c.get(get_url(limit=1))
+                    self.assertFalse(get_rate.called)
+                self.assertEqual(json.loads(result.data), {u'result': [free]})
+
+                # Limits which are not a positive integer are rejected
+                for limit in ('-1', '0', '1.5', 'a'):
+                    self.assertEqual(
+                        c.get(get_url(limit=limit)).status_code, 400
+                    )
+
+    def test_0200_shipping_estimates(self):
+        """Precompute the cheapest shipping of each bucket of total amount
+        and weight, and refresh them when the configuration changes
+        """
+        Estimate = POOL.get('nereid.shipping.estimate')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            country = self.website.countries[0]
+            app = self.get_app()
+
+            flat_shipping = self._create_shipping('Flat Rate')
+            flat_rate, = self.Flat.create([{
+                'shipping': flat_shipping.id,
+                'price': Decimal('10.0'),
+            }])
+            free_rate, = self.Free.create([{
+                'shipping': self._create_shipping('Free Rate').id,
+                'minimum_order_value': Decimal('100.0'),
+            }])
+            self.Table.create([{
+                'shipping': self._create_shipping('Table Rate').id,
+                'factor': 'total_weight',
+                'lines': [('create', [{
+                    'factor': 2.0,
+                    'price': Decimal('5.0'),
+                }])],
+            }])
+            self.assertTrue(self.website.shipping_estimates_stale)
+
+            Estimate.refresh_estimates()
+            self.assertFalse(
+                self.Website(self.website.id).shipping_estimates_stale
+            )
+
+            # Only the buckets where the cheapest option changes are kept
+            estimates = Estimate.search([
+                ('website', '=', self.website.id),
+                ('country', '=', country.id),
+                ('guest', '=', False),
+                ('weight', '=', 0.5),
+            ], order=[('total_amount', 'ASC')])
+            self.assertEqual(
+                [(e.total_amount, e.name, e.amount) for e in estimates], [
+                    (0.0, u'Flat Rate', Decimal('10.0')),
+                    (100.0, u'Free Rate', Decimal('0.0')),
+                ]
+            )
+
+            for total_amount, weight, expected in [
+                    (Decimal('60'), 0.3, (u'Flat Rate', Decimal('10.0'))),
+                    (Decimal('60'), 3, (u'Table Rate', Decimal('5.0'))),
+                    (Decimal('120'), 3, (u'Free Rate', Decimal('0.0'))),
+                    (Decimal('60'), 100, (u'Table Rate', Decimal('5.0')))]:
+                estimate = Estimate.get_estimate(
+                    self.website.id, country.id, total_amount, weight
+                )
+                self.assertEqual((estimate.name, estimate.amount), expected)
+
+            # Product pages read the estimates
+            with app.test_request_context('/'):
+                app.preprocess_request()
+                estimate = self.product.get_shipping_estimate(country.id)
+                self.assertEqual(estimate.name, u'Flat Rate')
+
+            # A change of the configuration marks only the website stale
+            self.Flat.write([flat_rate], {'price': Decimal('20.0')})
+            self.assertTrue(
+                self.Website(self.website.id).shipping_estimates_stale
+            )
+            with patch.object(
+                    Estimate, 'compute_estimates',
+                    wraps=Estimate.compute_estimates) as compute_estimates:
+                Estimate.refresh_estimates()
+                Estimate.refresh_estimates()
+                self.assertEqual(compute_estimates.call_count, 1)
+            estimate = Estimate.get_estimate(
+                self.website.id, country.id, Decimal('60'), 0.3
+            )
+            self.assertEqual(estimate.amount, Decimal('20.0'))
+
+    def test_0210_rate_options(self):
+        """The options put by the methods must be collected as rate
+        options tagged with the method model
+        """
+        from trytond.modules.nereid_shipping.quote import (
+            RateOption, RateCollector
+        )
+
+        collector = RateCollector('nereid.shipping.method.flat')
+        collector.put({'id': 1, 'name': u'Flat Rate', 'amount': 10.0})
+        collector.put(RateOption(2, u'Free Rate', 0.0))
+        collector.put(RateOption(3, u'Table', 5.0, 'other.model'))
+        self.assertEqual(collector.qsize(), 3)
+        self.assertEqual(
+            [option.model for option in collector.options], [
+                'nereid.shipping.method.flat', 'nereid.shipping.method.flat',
+                'other.model',
+            ]
+        )
+
+        option = collector.options[0]
+        self.assertRaises(AttributeError, setattr, option, 'amount', 0)
+        self.assertEqual(RateOption.from_dict(option.as_dict()), option)
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            country = self.website.countries[0]
+            destination = {
+                'zip': '682013',
+                'subdivision': country.subdivisions[0].id,
+                'country': country.id,
+            }
+            flat_rate, = self.Flat.create([{
+                'shipping': self._create_shipping('Flat Rate').id,
+                'price': Decimal('10.0'),
+            }])
+
+            with app.test_request_context('/'):
+                app.preprocess_request()
+                options = self.Shipping._get_available_methods(
+                    **destination
+                )
+                self.assertEqual(options, [RateOption(
+                    flat_rate.id, u'Flat Rate', 10.0,
+                    'nereid.shipping.method.flat'
+                )])
+                # From the quote cache
+                self.assertEqual(
+                    self.Shipping._get_available_methods(**destination),
+                    options
+                )
+
+    def test_0220_shipping_eligibility(self):
+        """The eligibility of a website must follow its configuration, and
+        not be rebuilt for changes which do not affect it
+        """
+        from trytond.modules.nereid_shipping.quote import QuoteContext
+
+        Eligibility = POOL.get('nereid.shipping.eligibility')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            country1, country2 = self.website.countries[0:2]
+
+            ship_flat = self._create_shipping('Flat Rate')
+            ship_table = self._create_shipping('Table Rate')
+            self.Shipping.write([ship_table], {
+                'available_countries': [('unlink', [country2.id])],
+                'is_allowed_for_guest': False,
+            })
+            flat_rate, = self.Flat.create([{
+                'shipping': ship_flat.id,
+                'price': Decimal('10.0'),
+            }])
+            table, = self.Table.create([{
+                'shipping': ship_table.id,
+                'factor': 'total_price',
+            }])
+
+            def eligibility(country):
+                return sorted(
+                    (row.method_model, row.method_id, row.guest_allowed)
+                    for row in Eligibility.search([
+                        ('website', '=', self.website.id),
+                        ('country', '=', country.id),
+                    ])
+                )
+
+            self.assertEqual(eligibility(country1), [
+                (self.Flat.__name__, flat_rate.id, True),
+                (self.Table.__name__, table.id, False),
+            ])
+            self.assertEqual(eligibility(country2), [
+                (self.Flat.__name__, flat_rate.id, True),
+            ])
+
+            with patch.object(
+                    Eligibility, 'rebuild',
+                    wraps=Eligibility.rebuild) as rebuild:
+                self.TableLine.create([{
+                    'table': table.id,
+                    'country': country1.id,
+                    'factor': 0.0,
+                    'price': Decimal('5.0'),
+                }])
+                self.assertEqual(rebuild.call_count, 0)
+
+                ship_flat.active = False
+                ship_flat.save()
+                self.assertEqual(rebuild.call_count, 1)
+            self.assertEqual(eligibility(country2), [])
+
+            self.Table.delete([table])
+            self.assertEqual(eligibility(country1), [])
+
+            # A method model which does not rebuild the eligibility when it
+            # changes is always dispatched
+            class Provider(object):
+                _fields = {'shipping': None}
+
+                @classmethod
+                def get_rate(cls, **kwargs):
+                    pass
+
+            with nested(
+                    patch.dict(
+                        POOL._pool[DB_NAME]['model'],
+                        {'test.shipping.provider': Provider}),
+                    patch.object(self.Shipping, '_rate_providers', [])):
+                self.Shipping.register_rate_provider('test.shipping.provider')
+                Eligibility.rebuild([self.website.id])
+                self.assertEqual(
+                    self.Shipping.get_eligible_method_models(
+                        country=country1.id,
+                        quote_context=QuoteContext.from_snapshot(
+                            self.website.id, True, Decimal('0'), 0, 0
+                        )
+                    ),
+                    ['test.shipping.provider']
+                )
+
+    def test_0230_rate_card_import_export(self):
+        """The lines of a table must be imported from a rate card in
+        chunks, replacing the existing lines if asked to, and exported
+        back as the same rate card
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            country = self.website.countries[0]
+            subdivision = country.subdivisions[0]
+
+            table, = self.Table.create([{
+                'shipping': self._create_shipping('Table Rate').id,
+                'factor': 'total_price',
+            }])
+            self.TableLine.create([{
+                'table': table.id,
+                'factor': 0.0,
+                'price': Decimal('99'),
+            }])
+
+            rate_card = '\r\n'.join([
+                'country,subdivision,zip,factor,price,zip_match,zip_end',
+                '%s,%s,682013,0.0,5,exact,' % (country.code, subdivision.code),
+                '%s,%s,,10.5,4.50,exact,' % (country.code, subdivision.code),
+                '%s,,,0.0,7,exact,' % country.code.lower(),
+                ',,,0.0,9,exact,',
+                '%s,,68,0.0,3,prefix,' % country.code,
+                '%s,,68000,0.0,4,range,68999' % country.code,
+                '',
+            ])
+            self.assertEqual(self.Table.import_lines(
+                table, StringIO(rate_card), replace=True, chunk_size=3
+            ), 6)
+            lines = self.TableLine.search(
+                [('table', '=', table.id)], order=[('id', 'ASC')]
+            )
+            self.assertEqual([(
+                line.country, line.subdivision, line.zip, line.factor,
+                line.price, line.zip_match,
+            ) for line in lines], [
+                (country, subdivision, u'682013', 0.0, Decimal('5'), 'exact'),
+                (country, subdivision, None, 10.5, Decimal('4.50'), 'exact'),
+                (country, None, None, 0.0, Decimal('7'), 'exact'),
+                (None, None, None, 0.0, Decimal('9'), 'exact'),
+                (country, None, u'68', 0.0, Decimal('3'), 'prefix'),
+                (country, None, u'68000', 0.0, Decimal('4'), 'range'),
+            ])
+            self.assertEqual(lines[-1].zip_end, u'68999')
+
+            stream = StringIO()
+            self.assertEqual(self.Table.export_lines(
+                table, stream, chunk_size=4
+            ), 6)
+            self.assertEqual(stream.getvalue(), rate_card.replace(
+                '\n%s,' % country.code.lower(), '\n%s,' % country.code
+            ))
+
+            # Invalid rate cards are not imported at all
+            for invalid in (
+                    'country,zip,factor,price\r\n',
+                    'country,subdivision,zip,factor,price\r\nXX,,,0,1\r\n',
+                    'country,subdivision,zip,factor,price\r\n,%s,,0,1\r\n'
+                    % subdivision.code,
+                    'country,subdivision,zip,factor,price\r\n,,,a,1\r\n'):
+                self.assertRaises(
+                    UserError, self.Table.import_lines, table,
+                    StringIO(invalid)
+                )
+            self.assertEqual(
+                self.TableLine.search([('table', '=', table.id)], count=True),
+                6
+            )
+
+    def test_0240_zip_rules(self):
+        """Lines must match zips by prefix and range, from the most
+        specific rule to the least specific one
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            country = self.website.countries[0]
+            subdivision = country.subdivisions[0]
+
+            table, = self.Table.create([{
+                'shipping': self._create_shipping('Table Rate').id,
+                'factor': 'total_price',
+            }])
+            self.TableLine.create([dict(values, **{
+                'table': table.id,
+                'country': country.id,
+                'factor': 0.0,
+            }) for values in [
+                {'subdivision': subdivision.id, 'price': Decimal('6')},
+                {'subdivision': subdivision.id, 'zip': '682013',
+                    'price': Decimal('1')},
+                {'subdivision': subdivision.id, 'zip': '6820',
+                    'zip_match': 'prefix', 'price': Decimal('2')},
+                {'subdivision': subdivision.id, 'zip': '68',
+                    'zip_match': 'prefix', 'price': Decimal('3')},
+                {'subdivision': subdivision.id, 'zip': '68000',
+                    'zip_match': 'range', 'zip_end': '68999',
+                    'price': Decimal('4')},
+                {'zip': '682', 'zip_match': 'prefix', 'price': Decimal('5')},
+            ]])
+
+            def prices(zip, subdivision=subdivision.id):
+                return [
+                    slab_index.find(0)
+                    for slab_index in self.Table.get_slab_indexes(
+                        table, country.id, subdivision, zip
+                    )
+                ]
+
+            self.assertEqual(prices('682013'), [1, 2, 5, 3, 4, 6])
+            self.assertEqual(prices(' 682101 '), [5, 3, 4, 6])
+            self.assertEqual(prices('68100'), [3, 4, 6])
+            self.assertEqual(prices('690000'), [6])
+            self.assertEqual(prices(None), [6])
+            self.assertEqual(prices('682013', None), [5])
+
+            # Ranges must be digits of the same length in order
+            for values in [
+                    {'zip': '6800', 'zip_end': '68999'},
+                    {'zip': '68999', 'zip_end': '68000'},
+                    {'zip': 'AB000', 'zip_end': 'AB999'},
+                    {'zip': None, 'zip_end': '68999'}]:
+                self.assertRaises(UserError, self.TableLine.create, [dict(
+                    values, table=table.id, country=country.id, factor=0.0,
+                    price=Decimal('1'), zip_match='range'
+                )])
+
+    def test_0250_carrier_rates(self):
+        """The requests of carrier methods must be sent concurrently over
+        pooled connections, and given up on after their timeout
+        """
+        from trytond.modules.nereid_shipping.carrier import (
+            RateRequest, ConnectionPool, CarrierFetch, CarrierRateMixin,
+            connection_pool
+        )
+        from trytond.modules.nereid_shipping.quote import RateOption
+        from trytond.modules.nereid_shipping.stats import rate_stats
+
+        server = StubCarrierServer(('127.0.0.1', 0), StubCarrierHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = 'http://127.0.0.1:%d/rate?' % server.server_address[1]
+        try:
+            pool = ConnectionPool()
+            start = time.time()
+            responses = CarrierFetch([
+                RateRequest(url + 'amount=1&delay=0.3'),
+                RateRequest(url + 'amount=2&delay=0.3', body='{}'),
+            ], 5, pool).wait()
+            self.assertTrue(time.time() - start < 0.55)
+            self.assertTrue(all(response.ok for response in responses))
+            self.assertEqual(
+                [response.json()['amount'] for response in responses], [1, 2]
+            )
+            self.assertEqual(server.connections, 2)
+
+            # Idle connections are reused
+            response, = CarrierFetch(
+                [RateRequest(url + 'amount=3')], 5, pool
+            ).wait()
+            self.assertEqual(response.json()['amount'], 3)
+            self.assertEqual(server.connections, 2)
+
+            start = time.time()
+            response, = CarrierFetch(
+                [RateRequest(url + 'amount=4&delay=1')], 0.2, pool
+            ).wait()
+            self.assertTrue(time.time() - start < 0.9)
+            self.assertFalse(response.ok)
+            self.assertTrue(isinstance(response.error, socket.timeout))
+            pool.clear()
+
+            with Transaction().start(DB_NAME, USER, CONTEXT):
+                self.setup_defaults()
+                country = self.website.countries[0]
+                destination = {
+                    'zip': '682013',
+                    'subdivision': country.subdivisions[0].id,
+                    'country': country.id,
+                }
+                flat_rate, = self.Flat.create([{
+                    'shipping': self._create_shipping('Flat Rate').id,
+                    'price': Decimal('10.0'),
+                }])
+
+                def get_rate_requests(cls, **kwargs):
+                    return [RateRequest(
+                        url + 'amount=12.5&delay=0.3', data=flat_rate.id
+                    )]
+
+                def parse_rate_responses(cls, responses, queue, **kwargs):
+                    for response in responses:
+                        if response.ok:
+                            queue.put(RateOption(
+                                response.request.data, u'Carrier',
+                                response.json()['amount']
+                            ))
+
+                app = self.get_app(SHIPPING_QUOTE_CACHE_TTL=0)
+                with nested(
+                        patch.multiple(
+                            self.Flat, create=True, rate_cost=100,
+                            get_rate=classmethod(
+                                CarrierRateMixin.get_rate.im_func
+                            ),
+                            get_rate_requests=classmethod(get_rate_requests),
+                            parse_rate_responses=classmethod(
+                                parse_rate_responses
+                            )),
+                        app.test_request_context('/')):
+                    app.preprocess_request()
+                    self.assertEqual(
+                        self.Shipping._get_available_methods(**destination),
+                        [RateOption(
+                            flat_rate.id, u'Carrier', 12.5,
+                            'nereid.shipping.method.flat'
+                        )]
+                    )
+
+                    app.config['SHIPPING_CARRIER_TIMEOUT'] = 0.1
+                    app.config['SHIPPING_QUOTE_CACHE_TTL'] = 300
+                    start = time.time()
+                    self.assertEqual(
+                        self.Shipping._get_available_methods(**destination),
+                        []
+                    )
+                    self.assertTrue(time.time() - start < 0.3)
+
+                    # The quote without the timed out carrier is not cached
+                    app.config['SHIPPING_CARRIER_TIMEOUT'] = 5
+                    self.assertEqual(
+                        len(self.Shipping._get_available_methods(
+                            **destination
+                        )), 1
+                    )
+
+                    # The requests of a carrier method are not sent once a
+                    # pruned quote is known without it
+                    free_rate, = self.Free.create([{
+                        'shipping': self._create_shipping('Free Rate').id,
+                        'minimum_order_value': Decimal('0.0'),
+                    }])
+                    with patch.object(
+                            self.Flat, 'get_rate_requests',
+                            wraps=self.Flat.get_rate_requests) as requests:
+                        self.assertEqual([
+                            option.id for option in
+                            self.Shipping._get_pruned_methods(
+                                first_available=True, **destination
+                            )
+                        ], [free_rate.id])
+                        self.assertFalse(requests.called)
+
+                    # A carrier method which fails is left out of the quote,
+                    # which is not cached
+                    def fail(cls, *args, **kwargs):
+                        raise ValueError('Bad carrier')
+
+                    rate_stats.reset()
+                    for name in ('get_rate_requests', 'parse_rate_responses'):
+                        with patch.object(self.Flat, name, classmethod(fail)):
+                            self.assertEqual([
+                                option.id for option in
+                                self.Shipping._get_available_methods(
+                                    **destination
+                                )
+                            ], [free_rate.id])
+                    stats = self.Shipping.get_rate_stats()
+                    self.assertEqual(stats[
+                        'nereid.shipping.method.flat/requests'
+                    ]['errors'], 1)
+                    self.assertEqual(
+                        stats['nereid.shipping.method.flat']['errors'], 1
+                    )
+                    self.assertEqual(
+                        len(self.Shipping._get_available_methods(
+                            **destination
+                        )), 2
+                    )
+        finally:
+            connection_pool.clear()
+            server.shutdown()
+            server.server_close()
+
+    def test_0260_shared_cache(self):
+        """Quotes and rate plans must be shared by the processes through
+        the backend, under the version of the configuration of a website
+        """
+        from trytond.modules.nereid_shipping.cache import (
+            SharedCache, FileBackend, get_backend
+        )
+
+        directory = tempfile.mkdtemp()
+        server = StubRedisServer(('127.0.0.1', 0), StubRedisHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            with Transaction().start(DB_NAME, USER, CONTEXT):
+                for url in (
+                        'file://%s' % directory,
+                        'redis://:secret@127.0.0.1:%d/2'
+                        % server.server_address[1]):
+                    # Caches of two processes
+                    cache1, cache2 = SharedCache('test'), SharedCache('test')
+                    cache1.backend = get_backend('test', url)
+                    cache2.backend = get_backend('test', url)
+
+                    self.assertEqual(
+                        cache1.set(1, 0, 'key', (1, 2)), (1, 2)
+                    )
+                    self.assertEqual(cache2.get(1, 0, 'key'), (1, 2))
+                    cache1.set(2, 0, 'key', 'other')
+                    self.assertEqual(cache1.get(1, 1, 'key'), None)
+                    self.assertEqual(cache1.get(2, 0, 'key'), 'other')
+
+                self.assertEqual(server.commands[:2], ['AUTH', 'SELECT'])
+
+                # Entries expire
+                cache1.backend = FileBackend(directory)
+                cache1.set(1, 0, 'key', 'value', 0.01)
+                time.sleep(0.02)
+                self.assertEqual(
+                    cache1.get(1, 0, 'key', 'expired'), 'expired'
+                )
+
+                # Expired entries are swept when the cache is cleared, and
+                # the entries which expire first beyond the limit
+                swept = os.path.join(directory, 'swept')
+                backend = cache1.backend = FileBackend(swept, max_entries=2)
+                for ttl in (0.01, 30, 10, 20):
+                    cache1.set(1, 0, ttl, ttl, ttl)
+                time.sleep(0.02)
+                cache1.clear()
+                self.assertEqual(len(os.listdir(swept)), 2)
+                self.assertEqual(cache1.get(1, 0, 10), None)
+                self.assertEqual(cache1.get(1, 0, 30), 30)
+
+                # A failed write leaves no temporary file
+                self.assertRaises(
+                    Exception, backend.set, 'key', lambda: None, 30
+                )
+                self.assertEqual(len(os.listdir(swept)), 2)
+
+                # Errors of the backend are misses
+                server.shutdown()
+                server.server_close()
+                cache2.backend._local.connection.close()
+                self.assertEqual(cache2.get(1, 0, 'key', 'missed'), 'missed')
+
+            with Transaction().start(DB_NAME, USER, CONTEXT):
+                self.setup_defaults()
+                country = self.website.countries[0]
+                destination = {
+                    'zip': '682013',
+                    'subdivision': country.subdivisions[0].id,
+                    'country': country.id,
+                }
+                flat_rate, = self.Flat.create([{
+                    'shipping': self._create_shipping('Flat Rate').id,
+                    'price': Decimal('10.0'),
+                }])
+
+                app = self.get_app()
+                with nested(
+                        patch.object(
+                            self.Shipping._quote_cache, '_backend',
+                            FileBackend(directory)),
+                        patch.object(
+                            self.Shipping._rate_plan_cache, '_backend',
+                            FileBackend(directory)),
+                        app.test_request_context('/')):
+                    app.preprocess_request()
+                    options = self.Shipping._get_available_methods(
+                        **destination
+                    )
+                    self.assertEqual(options[0].amount, 10.0)
+
+                    with patch.object(
+                            self.Flat, 'get_rate',
+                            side_effect=AssertionError) as get_rate:
+                        self.Shipping._get_available_methods(**destination)
+                        self.assertEqual(get_rate.call_count, 0)
+
+                    self.Flat.write([flat_rate], {'price': Decimal('12.0')})
+                    options = self.Shipping._get_available_methods(
+                        **destination
+                    )
+                    self.assertEqual(options[0].amount, 12.0)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_0270_config_version(self):
+        """The version of the shipping configuration of a website must be
+        incremented by every change to the configuration, and only then
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            Website = self.Website
+            versions = []
+
+            def assertBumped(bumped=True):
+                versions.append(
+                    Website(self.website.id).shipping_config_version
+                )
+                if len(versions) > 1:
+                    self.assertEqual(versions[-1] > versions[-2], bumped)
+
+            assertBumped()
+            shipping = self._create_shipping('Flat Rate')
+            assertBumped()
+            flat_rate, = self.Flat.create([{
+                'shipping': shipping.id, 'price': Decimal('10.0'),
+            }])
+            assertBumped()
+            self.Flat.write([flat_rate], {'price': Decimal('12.0')})
+            assertBumped()
+            Website.write([self.website], {
+                'allowed_ship_methods': [('add', [shipping.id])],
+            })
+            assertBumped()
+
+            # Changes to the website outside of its shipping configuration
+            Website.write([self.website], {'name': 'Other Name'})
+            assertBumped(False)
+
+            self.Flat.delete([flat_rate])
+            assertBumped()
+
+            # A counter which repeats, like after a rolled back change or a
+            # restored database, is still another version
+            version = self.Shipping.get_config_version(self.website.id)
+            Website.bump_shipping_config_version([self.website.id])
+            Website.write([self.website], {
+                'shipping_config_version': versions[-1],
+            })
+            self.assertNotEqual(
+                self.Shipping.get_config_version(self.website.id), version
+            )
+
+            # The rate plan is cached under the version
+            plan = self.Shipping.get_rate_plan(Website(self.website.id))
+            self.assertTrue(
+                self.Shipping.get_rate_plan(Website(self.website.id)) is plan
+            )
+            Website.bump_shipping_config_version([self.website.id])
+            self.assertTrue(
+                self.Shipping.get_rate_plan(Website(self.website.id))
+                is not plan
+            )
+
+    def test_0280_allowed_ship_methods(self):
+        """Only the method models with a record allowed on the website
+        which ships to the destination country must be dispatched
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            country = self.website.countries[0]
+            destination = {
+                'zip': '682013',
+                'subdivision': country.subdivisions[0].id,
+                'country': country.id,
+            }
+            ship_flat = self._create_shipping('Flat Rate')
+            ship_free = self._create_shipping('Free')
+            self.Flat.create([{
+                'shipping': ship_flat.id,
+                'price': Decimal('10.0'),
+            }])
+            self.Free.create([{
+                'shipping': ship_free.id,
+                'minimum_order_value': Decimal('0'),
+            }])
+
+            app = self.get_app(SHIPPING_QUOTE_CACHE_TTL=0)
+            with app.test_request_context('/'):
+                app.preprocess_request()
+
+                # Every method of the website is offered by default
+                self.assertEqual(
+                    set(self.Shipping.get_eligible_method_models(
+                        **destination
+                    )), set([self.Flat.__name__, self.Free.__name__])
+                )
+
+                self.Website.write([self.website], {
+                    'allowed_ship_methods': [('add', [ship_flat.id])],
+                })
+                with nested(
+                        patch.object(
+                            self.Free, 'get_rate',
+                            side_effect=AssertionError),
+                        patch.object(
+                            self.Table, 'get_rate',
+                            side_effect=AssertionError)):
+                    options = self.Shipping._get_available_methods(
+                        **destination
+                    )
+                self.assertEqual(
+                    [option.model for option in options], [self.Flat.__name__]
+                )
+
+    def test_0290_quote_tokens(self):
+        """The quote kept in the session must be signed tokens, which are
+        rejected when tampered with or expired
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            country = self.website.countries[0]
+            flat_rate, = self.Flat.create([{
+                'shipping': self._create_shipping('Flat Rate').id,
+                'price': Decimal('10.0'),
+            }])
+
+            destination = {
+                'zip': u'682013',
+                'subdivision': country.subdivisions[0].id,
+                'country': country.id,
+            }
+            app = self.get_app(SHIPPING_QUOTE_CACHE_TTL=0)
+            with app.test_client() as c:
+                c.get('/_available_shipping_methods?' + urlencode(
+                    destination
+                ))
+                token, = session['shipping_quote']
+
+                option, key = self.Shipping.load_quote_token(token)
+                self.assertEqual(option.id, flat_rate.id)
+                self.assertEqual(option.model, self.Flat.__name__)
+                self.assertEqual(option.amount, Decimal('10.0'))
+
+                self.assertEqual(
+                    self.Shipping.load_quote_token(token[:-1] + '_'), None
+                )
+                self.assertEqual(
+                    self.Shipping.load_quote_token(token.replace(
+                        token.split('.')[0],
+                        self.Shipping.get_quote_serializer().dumps([
+                            self.Flat.__name__, flat_rate.id, 'Flat Rate',
+                            '0', key,
+                        ]).split('.')[0]
+                    )), None
+                )
+                # Changes to the configuration make the quote stale
+                self.assertEqual(
+                    self.Shipping._get_quote_digest(**destination), key
+                )
+                self.Flat.write([flat_rate], {'price': Decimal('12.0')})
+                self.assertNotEqual(
+                    self.Shipping._get_quote_digest(**destination), key
+                )
+
+                # Tokens which cannot be decoded are stale
+                for values in (
+                        [self.Flat.__name__, flat_rate.id, 'Flat Rate', 'None',
+                            key],
+                        [self.Flat.__name__, flat_rate.id]):
+                    self.assertEqual(self.Shipping.load_quote_token(
+                        self.Shipping.get_quote_serializer().dumps(values)
+                    ), None)
+
+                app.config['SHIPPING_QUOTE_TOKEN_TTL'] = -1
+                self.assertEqual(self.Shipping.load_quote_token(token), None)
+
+                # Options without an amount are not kept
+                with patch.object(
+                        self.Flat, 'get_rate', classmethod(
+                            lambda cls, queue, **kwargs: queue.put({
+                                'id': flat_rate.id, 'name': u'Flat Rate',
+                                'amount': None,
+                            })
+                        )):
+                    result = c.get('/_available_shipping_methods?' + urlencode(
+                        destination
+                    ))
+                self.assertEqual(json.loads(result.data), {u'result': [
+                    [flat_rate.id, u'Flat Rate', None],
+                ]})
+                self.assertEqual(session['shipping_quote'], [])
+
+    def test_0300_multiple_rates(self):
+        """Every eligible record of a method must be an option, with the
+        same number of queries whatever their number
+        """
+        from trytond.modules.nereid_shipping.stats import count_queries
+        from trytond.modules.nereid_shipping.quote import QuoteContext
+        Translation = POOL.get('ir.translation')
+        Rule = POOL.get('ir.rule')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            country = self.website.countries[0]
+            quote_context = QuoteContext.from_snapshot(
+                self.website.id, False, Decimal('100'), 1.0, 1.0
+            )
+
+            def get_options(Method):
+                self.Shipping.clear_config_cache()
+                website = self.Website(self.website.id)
+                self.Shipping.get_rate_plan(website)
+                Transaction().cursor.cache.clear()
+                Translation._translation_cache.clear()
+                Rule._domain_get_cache.clear()
+                with count_queries(Transaction().cursor) as queries:
+                    options = Method.get_rate_options(
+                        website, quote_context, country.id
+                    )
+                return options, queries[0]
+
+            self.Flat.create([{
+                'shipping': self._create_shipping('Standard').id,
+                'price': Decimal('5.0'),
+            }])
+            options, queries = get_options(self.Flat)
+            self.assertEqual(len(options), 1)
+
+            self.Flat.create([{
+                'shipping': self._create_shipping('Express').id,
+                'price': Decimal('15.0'),
+            }, {
+                'shipping': self._create_shipping('Overnight').id,
+                'price': Decimal('25.0'),
+            }])
+            options, more_queries = get_options(self.Flat)
+            self.assertEqual(
+                [(o.name, o.amount) for o in options],
+                [('Standard', 5.0), ('Express', 15.0), ('Overnight', 25.0)]
+            )
+            self.assertEqual(more_queries, queries)
+
+            self.Free.create([{
+                'shipping': self._create_shipping('Free').id,
+                'minimum_order_value': Decimal('50.0'),
+            }])
+            options, queries = get_options(self.Free)
+            self.assertEqual([o.name for o in options], ['Free'])
+
+            self.Free.create([{
+                'shipping': self._create_shipping('Free Express').id,
+                'minimum_order_value': Decimal('500.0'),
+            }, {
+                'shipping': self._create_shipping('Free Saver').id,
+                'minimum_order_value': Decimal('0.0'),
+            }])
+            options, more_queries = get_options(self.Free)
+            self.assertEqual(
+                [o.name for o in options], ['Free', 'Free Saver']
+            )
+            self.assertEqual(more_queries, queries)
+
+            def create_tables(*names):
+                for name, price in names:
+                    table, = self.Table.create([{
+                        'shipping': self._create_shipping(name).id,
+                        'factor': 'total_price',
+                    }])
+                    self.TableLine.create([{
+                        'table': table.id,
+                        'country': country.id,
+                        'factor': 0.0,
+                        'price': Decimal(price),
+                    }])
+
+            create_tables(('Table', '8.0'))
+            options, queries = get_options(self.Table)
+            self.assertEqual(len(options), 1)
+
+            create_tables(
+                ('Table Express', '18.0'), ('Table Overnight', '28.0')
+            )
+            options, more_queries = get_options(self.Table)
+            self.assertEqual(
+                [(o.name, o.amount) for o in options], [
+                    ('Table', 8.0), ('Table Express', 18.0),
+                    ('Table Overnight', 28.0),
+                ]
+            )
+            self.assertEqual(more_queries, queries)
+
 
 def suite():
     "Shipping test suite"